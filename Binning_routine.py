@@ -7,8 +7,11 @@
 # see http://www.biopython.org/DIST/LICENSE for the complete license
 
 
+from itertools import islice
 from math import ceil, floor, log
+from operator import le
 import sys
+import time
 
 #set up integer_types variable for interpreter neutral code
 #that accomodates integers larger than 2**31
@@ -52,7 +55,26 @@ class StupidFeatureBinCollection(object):
         
         self._is_sorted = False
         self._bins.append(feature_tuple)
-    
+
+    def extend(self, iterable, chunk_size=65536, callback=None, presorted=False):
+        tbegin = time.time()
+        inserted = 0
+        in_order = presorted and (self._is_sorted or not self._bins)
+        for feature_tuple in iterable:
+            if in_order and self._bins and self._bins[-1] > feature_tuple:
+                in_order = False
+            self.insert(feature_tuple)
+            inserted += 1
+            if callback is not None and inserted % chunk_size == 0:
+                elapsed = time.time() - tbegin
+                callback(inserted, elapsed, inserted/elapsed if elapsed > 0 else float("inf"))
+        if callback is not None and inserted % chunk_size:
+            elapsed = time.time() - tbegin
+            callback(inserted, elapsed, inserted/elapsed if elapsed > 0 else float("inf"))
+        if in_order:
+            self._is_sorted = True
+        return inserted
+
     def sort(self):
         self._bins.sort()
         self._is_sorted = True 
@@ -313,22 +335,183 @@ class FeatureBinCollection(object):
         
         bin_index = self._calculate_bin_index(begin, span)
         self._bins[bin_index].append(feature_tuple)
-        
+
+    def extend(self, iterable, chunk_size=65536, callback=None, presorted=False):
+        """inserts every feature tuple of an iterable into the feature bins
+
+        The iterable is consumed lazily, chunk_size tuples at a time, so a
+        generator (a parser or a parser consumer) can be indexed without being
+        materialized first. Only one chunk is ever held here; the source is
+        not asked for more data until the previous chunk has been binned.
+
+        kwargs:
+
+          chunk_size:
+            the number of tuples pulled from the iterable and binned together.
+            Bin sizes are fixed once per chunk and the bin indices of the
+            whole chunk are then computed in one pass.
+
+          callback:
+            when provided, it is called after every chunk as
+            callback(inserted, elapsed, rate) where inserted is the running
+            count of features, elapsed is the time in seconds since extend
+            was called and rate is the throughput in features per second.
+
+          presorted:
+            when True the features are expected in order of their begin index
+            (in tuple order when beginindex is 0). Each chunk is checked for
+            order, the features of a chunk out of order are checked against
+            the end of their bin, and only the bins that broke order (or were
+            merged by a resize) are sorted at the end. A sorted collection thus
+            stays sorted without a sort() pass. Unordered input is still binned
+            correctly. It has no effect when the collection already holds
+            unsorted features.
+
+        returns the number of features inserted
+        """
+        if not _is_int_or_long(chunk_size) or chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer")
+        #bins known to be out of order, tracked only for presorted input
+        unsorted = None
+        if presorted and (self._sorted or not any(self._bins)):
+            unsorted = set()
+            #the last key of each sorted bin is its largest
+            stored = self._order_keys([bin[-1] for bin in self._bins if bin])
+            highest = max(stored) if stored else None
+        iterator = iter(iterable)
+        inserted = 0
+        tbegin = time.time()
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                break
+            if unsorted is None:
+                self._insert_chunk(chunk)
+            else:
+                #an ordered chunk following everything stored keeps all bins
+                #in order, other chunks are checked bin by bin
+                keys = self._order_keys(chunk)
+                in_order = (highest is None or highest <= keys[0]) and \
+                           all(map(le, keys, islice(keys, 1, None)))
+                if in_order:
+                    highest = keys[-1]
+                elif highest is None:
+                    highest = max(keys)
+                else:
+                    highest = max(max(keys), highest)
+                self._insert_chunk(chunk, unsorted, in_order)
+            inserted += len(chunk)
+            if callback is not None:
+                elapsed = time.time() - tbegin
+                rate = inserted/elapsed if elapsed > 0 else float("inf")
+                callback(inserted, elapsed, rate)
+        if unsorted is not None:
+            self._sort_bins(unsorted)
+            self._sorted = True
+        return inserted
+
+    def _insert_chunk(self, chunk, unsorted=None, in_order=True):
+        """bins a list of feature tuples as a single batch
+
+        The data is checked the same way as insert() then the bin sizes are
+        fixed for the largest feature in the chunk. With the sizes known, the
+        level of each feature follows from the highest bit that differs between
+        its first and last residue; this avoids the per-level loop of
+        _calculate_bin_index() while producing the same bin indices.
+
+        When the set unsorted is given, the bins merged by growing the bin
+        sizes are added to it and, unless the chunk is known to be in_order,
+        so is every bin that receives a feature out of order.
+        """
+        beginindex = self._beginindex
+        endindex = self._endindex
+
+        #validate first so a bad tuple leaves the bins untouched
+        extent = 0
+        for feature_tuple in chunk:
+            begin = feature_tuple[beginindex]
+            end = feature_tuple[endindex]
+            assert _is_int_or_long(begin)
+            assert _is_int_or_long(end)
+            assert 0 <= begin <= end
+            extent = max(extent, begin + max(1, end-begin))
+        self._fit_bin_sizes(extent, unsorted)
+        self._sorted = False
+
+        bins = self._bins
+        lowest_level = self._bin_level_count - 1
+        min_bin_power = self._min_bin_power
+        max_bin_power = self._max_bin_power
+        level_offsets = [(2**(3*level) - 1)//7 for level in range(lowest_level+1)]
+        level_shifts = [max_bin_power - 3*level for level in range(lowest_level+1)]
+        for feature_tuple in chunk:
+            begin = feature_tuple[beginindex]
+            last = begin + max(1, feature_tuple[endindex]-begin) - 1
+            #every level up triples the bits shared by all residues of a bin
+            climb = ((begin ^ last).bit_length() - min_bin_power + 2)//3
+            level = lowest_level - max(0, climb)
+            bin_index = level_offsets[level] + (begin >> level_shifts[level])
+            if not in_order and bins[bin_index]:
+                last_tuple = bins[bin_index][-1]
+                if beginindex == 0:
+                    if last_tuple > feature_tuple:
+                        unsorted.add(bin_index)
+                elif last_tuple[beginindex] > begin:
+                    unsorted.add(bin_index)
+            bins[bin_index].append(feature_tuple)
+
+    def _fit_bin_sizes(self, extent, unsorted=None):
+        """grows the bins until a feature ending at extent can be stored
+
+        if the bin size is larger than expected, do some self-consistency
+        checks. Locked (non-dynamic) collections raise a ValueError instead.
+
+        Growing merges the lowest level bins and moves all bins, so when the
+        set of unsorted bins is given those are sorted first and the merged
+        bins, now at the lowest level, take their place in the set.
+        """
+        while extent > self._max_sequence_length:
+            if self._dynamic_size:
+                assert extent <= 2**41   # len(seq) > 2.19 trillion is not reasonable
+            elif not self._dynamic_size and extent > 2**self._max_bin_power:
+                error_string = "feature index at {}: must be less than 2^{}".format \
+                                                (extent, self._max_bin_power)
+                raise ValueError(error_string)
+            if unsorted is not None:
+                self._sort_bins(unsorted)
+                unsorted.clear()
+            self._increase_bin_sizes()
+            if unsorted is not None:
+                unsorted.update(range(4681, 37449))
+
     def __len__(self):
         return sum(len(bin) for bin in self._bins) 
 
     def sort(self):
         """this performs bin-centric sorting, necessary for faster retrieval"""
+        self._sort_bins(range(len(self._bins)))
+        #reset sorted quality
+        self._sorted = True
+
+    def _order_keys(self, features):
+        """the values the features of a bin are sorted by, see sort()"""
+        if self._beginindex == 0:
+            return features
+        beginindex = self._beginindex
+        return [feature_tuple[beginindex] for feature_tuple in features]
+
+    def _sort_bins(self, bin_indices):
+        """sorts the bins with the given indices by begin index"""
+        bins = self._bins
         #bins must be sorted by the begin index, this is fastest
         if self._beginindex == 0:
-            for i in range(len(self._bins)):
-                self._bins[i].sort()
+            for i in bin_indices:
+                bins[i].sort()
         #this is a bit slower but accomodates diverse data structures
         else:
-            for i in range(len(self._bins)):
-                self.bins[i].sort(key = lambda tup: tup[self._beginindex])
-        #reset sorted quality
-        self._sorted = True
+            beginindex = self._beginindex
+            for i in bin_indices:
+                bins[i].sort(key = lambda tup: tup[beginindex])
             
     def __getitem__(self, key):
         """This getter efficiently retrieves the required entries
@@ -394,6 +577,112 @@ class FeatureBinCollection(object):
                         break
         return return_entries
 
+    def within(self, start, stop):
+        """retrieves the features lying entirely inside [start, stop)
+
+        This gives the same result as filtering self[start:stop] for features
+        with start <= begin and end <= stop but scans far fewer features.
+        Zero length features at stop are included, as in self[start:stop].
+        A feature is stored in a bin above the lowest level only when it
+        crosses a boundary of the level below, so a level is skipped outright
+        unless such a boundary lies inside the query. Bins that are fully
+        covered by the query are taken whole and the remaining bins are
+        entered by binary search on the begin index.
+        """
+        keystart, keystop = self._check_query_range(start, stop)
+        beginindex = self._beginindex
+        endindex = self._endindex
+        if not self._sorted:
+            self.sort()
+
+        return_entries = []
+        lowest_level = self._bin_level_count - 1
+        max_bin_power = self._max_bin_power
+        for level in range(lowest_level+1):
+            offset_at_L = (2**(3*level) - 1)//7
+            size_at_L = 2**(max_bin_power - 3*level)
+            firstbegin = keystart
+            if level < lowest_level:
+                #features here cross a boundary of the next level down, only
+                #bins holding such a boundary inside the query are candidates
+                size_below = size_at_L >> 3
+                boundary = (keystart//size_below + 1)*size_below
+                if boundary >= keystop:
+                    continue
+                firstbegin = boundary
+            k1 = offset_at_L + firstbegin//size_at_L
+            if level < lowest_level:
+                k2 = offset_at_L + (keystop-1)//size_at_L
+            else:
+                #zero length features at stop are kept in the bin holding stop
+                k2 = offset_at_L + min(keystop, self._max_sequence_length-1)//size_at_L
+            for k in range(k1, k2+1):
+                bin = self._bins[k]
+                if not bin:
+                    continue
+                binbegin = (k - offset_at_L)*size_at_L
+                if keystart <= binbegin and binbegin+size_at_L <= keystop:
+                    return_entries.extend(bin)
+                    continue
+                for i in range(self._bisect_begin(bin, keystart), len(bin)):
+                    feature = bin[i]
+                    if feature[beginindex] > keystop:
+                        break
+                    if feature[endindex] <= keystop:
+                        return_entries.append(feature)
+        return return_entries
+
+    def containing(self, position):
+        """retrieves the features containing (stabbed by) a single residue
+
+        This gives the same result as self[position] but inspects exactly one
+        bin per level, and inside each bin only the features beginning at or
+        before position, found by binary search.
+        """
+        keystart, keystop = self._check_query_range(position, position+1)
+        beginindex = self._beginindex
+        endindex = self._endindex
+        if not self._sorted:
+            self.sort()
+
+        return_entries = []
+        if keystart == keystop:
+            return return_entries
+        max_bin_power = self._max_bin_power
+        for level in range(self._bin_level_count):
+            offset_at_L = (2**(3*level) - 1)//7
+            bin = self._bins[offset_at_L + (position >> (max_bin_power - 3*level))]
+            for i in range(self._bisect_begin(bin, position+1)):
+                feature = bin[i]
+                #zero length features at the position are kept, as in self[position]
+                if feature[endindex] > position or feature[beginindex] == position:
+                    return_entries.append(feature)
+        return return_entries
+
+    def _check_query_range(self, start, stop):
+        """validates an integer query range and clips it to the bins"""
+        if not (_is_int_or_long(start) and _is_int_or_long(stop)):
+            raise TypeError("lookups in the feature bin must use int positions")
+        if start < 0:
+            raise IndexError("key out of bounds")
+        if start > stop:
+            raise IndexError("key not valid, start > stop")
+        max_sequence_length = self._max_sequence_length
+        return min(start, max_sequence_length), min(stop, max_sequence_length)
+
+    def _bisect_begin(self, bin, value):
+        """index of the first feature of a sorted bin with begin >= value"""
+        beginindex = self._beginindex
+        lo = 0
+        hi = len(bin)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if bin[mid][beginindex] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
     def _calculate_bin_index(self, begin,span):
         """ This function returns a bin index given a (begin, span) interval
         
@@ -417,16 +706,8 @@ class FeatureBinCollection(object):
         #this is required for determination of bin location for zero length seq's
         span = max(1, span)
         
-        # fix bin sizes if needed. Also, if the bin size is
-        # larger than expected, do some self-consistency checks
-        while begin+span > self._max_sequence_length:
-            if self._dynamic_size:
-                assert begin+span <= 2**41   # len(seq) > 2.19 trillion is not reasonable
-            elif not self._dynamic_size and begin+span > 2**self._max_bin_power:
-                error_string = "feature index at {}: must be less than 2^{}".format \
-                                                (begin+span, self._max_bin_power)
-                raise ValueError(error_string)
-            self._increase_bin_sizes()
+        # fix bin sizes if needed.
+        self._fit_bin_sizes(begin+span)
             
         #run the assignment loop
         bin_level_count = self._bin_level_count
@@ -703,7 +984,180 @@ if __name__ ==  "__main__":
             self.assertIn(testTuple3,self.bins[8388604:8388605])
             self.assertIn(testTuple3,self.bins[8388605:8388606])
             self.assertEqual([],self.bins[8388603:8388604])
-            
+
+        def test_extend_from_generator(self):
+            features = ((i*1000, i*1000+500) for i in range(100))
+            inserted = self.bins.extend(features, chunk_size=7)
+            self.assertEqual(inserted, 100)
+            self.assertEqual(len(self.bins), 100)
+            self.assertEqual([(5000, 5500)], self.bins[5100:5200])
+
+        def test_extend_bins_match_insert(self):
+            import random
+            rand = random.Random(5)
+            features = []
+            for i in range(2000):
+                begin = rand.randint(0, 2**23)
+                span = rand.choice([0, 1, 255, 256, 257, rand.randint(0, 2**20)])
+                features.append((begin, min(2**23, begin+span)))
+            self.bins.extend(features, chunk_size=300)
+            insertedbins = FeatureBinCollection()
+            for feature in features:
+                insertedbins.insert(feature)
+            self.assertEqual(self.bins._bins, insertedbins._bins)
+
+        def test_extend_with_rearrangement(self):
+            testTuple3 = (256, 256+256)
+            testTuple5 = (0, 9000000)
+            self.bins.extend([testTuple3, testTuple5])
+            self.assertIn(testTuple3, self.bins._bins[4681])
+            self.assertIn(testTuple5, self.bins._bins[0])
+            self.assertEqual(self.bins._max_bin_power, 26)
+
+        def test_extend_callback_reports_progress(self):
+            progress = []
+            def callback(inserted, elapsed, rate):
+                self.assertTrue(elapsed >= 0)
+                self.assertTrue(rate > 0)
+                progress.append(inserted)
+            self.bins.extend(((i, i+1) for i in range(25)), chunk_size=10,
+                             callback=callback)
+            self.assertEqual(progress, [10, 20, 25])
+
+        def test_extend_bad_negative_val_leaves_bins_empty(self):
+            self.assertRaises(AssertionError, self.bins.extend, [(0, 56), (-1, 56)])
+            self.assertEqual(len(self.bins), 0)
+
+        def test_extend_static_collection_overflow(self):
+            staticbins = FeatureBinCollection(length=67108864)
+            self.assertRaises(ValueError, staticbins.extend, [(0, 67108865)])
+
+        def _random_features(self, count, seed):
+            import random
+            rand = random.Random(seed)
+            features = []
+            for i in range(count):
+                begin = rand.randint(0, 2**23)
+                span = rand.choice([0, 1, 300, rand.randint(0, 2**14), rand.randint(0, 2**21)])
+                features.append((begin, min(2**23, begin+span), i))
+            return features
+
+        def test_within_matches_filtered_overlap(self):
+            import random
+            rand = random.Random(7)
+            self.bins.extend(self._random_features(3000, 11))
+            for i in range(200):
+                start = rand.randint(0, 2**23)
+                stop = min(2**23, start + rand.choice([1, 256, 5000, 2**17, 2**22]))
+                expected = sorted(f for f in self.bins[start:stop] if start <= f[0] and f[1] <= stop)
+                self.assertEqual(sorted(self.bins.within(start, stop)), expected)
+
+        def test_within_edges(self):
+            feature = (100000,200000)
+            self.bins.insert(feature)
+            self.assertEqual([feature], self.bins.within(100000, 200000))
+            self.assertEqual([], self.bins.within(100001, 200000))
+            self.assertEqual([], self.bins.within(100000, 199999))
+            self.assertEqual([feature], self.bins.within(0, 2**30))
+            self.assertEqual([], self.bins.within(5, 5))
+            self.assertRaises(IndexError, self.bins.within, 200, 100)
+            self.assertRaises(IndexError, self.bins.within, -1, 100)
+
+        def test_within_zero_length_features(self):
+            features = [(1204, 1204), (1300, 1460), (1460, 1460), (1460, 1461),
+                        (1536, 1536), (2**23, 2**23)]
+            for feature in features:
+                self.bins.insert(feature)
+            self.assertEqual(sorted(self.bins.within(1204, 1460)),
+                             [(1204, 1204), (1300, 1460), (1460, 1460)])
+            self.assertEqual(sorted(self.bins.within(1204, 1460)),
+                             sorted(f for f in self.bins[1204:1460] if 1204 <= f[0] and f[1] <= 1460))
+            #stop on a bin boundary and at the end of the bins
+            self.assertEqual(self.bins.within(1500, 1536), [(1536, 1536)])
+            self.assertEqual(self.bins.within(1460, 1460), [(1460, 1460)])
+            self.assertEqual(self.bins.within(2**22, 2**23), [(2**23, 2**23)])
+
+        def test_containing_matches_overlap(self):
+            import random
+            rand = random.Random(9)
+            self.bins.extend(self._random_features(3000, 13))
+            for i in range(300):
+                position = rand.randint(0, 2**23 - 1)
+                self.assertEqual(sorted(self.bins.containing(position)),
+                                 sorted(self.bins[position]))
+
+        def test_containing_edges(self):
+            feature = (100000,200000)
+            zerolength = (300, 300)
+            self.bins.insert(feature)
+            self.bins.insert(zerolength)
+            self.assertEqual([feature], self.bins.containing(100000))
+            self.assertEqual([feature], self.bins.containing(199999))
+            self.assertEqual([], self.bins.containing(200000))
+            self.assertEqual([zerolength], self.bins.containing(300))
+            self.assertEqual([], self.bins.containing(2**30))
+            self.assertRaises(IndexError, self.bins.containing, -1)
+            self.assertRaises(TypeError, self.bins.containing, 5.5)
+
+        def test_extend_presorted_needs_no_sort(self):
+            features = sorted(f[:2] for f in self._random_features(3000, 19))
+            self.bins.extend(features, chunk_size=500, presorted=True)
+            self.assertTrue(self.bins._sorted)
+            sortedbins = FeatureBinCollection()
+            sortedbins.extend(features)
+            sortedbins.sort()
+            self.assertEqual(self.bins._bins, sortedbins._bins)
+
+        def test_extend_presorted_sorts_bins_out_of_order(self):
+            features = sorted(self._random_features(3000, 23))
+            features[100], features[2000] = features[2000], features[100]
+            features.append((5, 10, -1))
+            self.bins.extend(features, chunk_size=700, presorted=True)
+            self.assertTrue(self.bins._sorted)
+            sortedbins = FeatureBinCollection()
+            sortedbins.extend(features)
+            sortedbins.sort()
+            self.assertEqual(self.bins._bins, sortedbins._bins)
+
+        def test_extend_presorted_with_rearrangement(self):
+            features = sorted([(i*2000, i*2000+300) for i in range(5000)] +
+                              [(2**23 + i*2**18, 2**23 + i*2**18 + 500) for i in range(200)])
+            self.bins.extend(features, chunk_size=1000, presorted=True)
+            self.assertEqual(self.bins._max_bin_power, 26)
+            self.assertTrue(self.bins._sorted)
+            sortedbins = FeatureBinCollection()
+            sortedbins.extend(features)
+            sortedbins.sort()
+            self.assertEqual(self.bins._bins, sortedbins._bins)
+            self.assertEqual([(4000, 4300)], self.bins[4100:4200])
+
+        def test_extend_presorted_alternate_indices(self):
+            altbins = FeatureBinCollection(beginindex=1, endindex=2)
+            features = sorted(((f[2], f[0], f[1]) for f in self._random_features(1000, 29)),
+                              key=lambda f: f[1])
+            features.insert(10, features.pop(900))
+            altbins.extend(features, presorted=True)
+            self.assertTrue(altbins._sorted)
+            sortedbins = FeatureBinCollection(beginindex=1, endindex=2)
+            sortedbins.extend(features)
+            sortedbins.sort()
+            self.assertEqual(altbins._bins, sortedbins._bins)
+
+        def test_extend_presorted_after_unsorted_insert(self):
+            self.bins.insert((5000, 6000))
+            self.bins.extend([(0, 100), (200, 300)], presorted=True)
+            self.assertFalse(self.bins._sorted)
+            self.assertEqual([(0, 100), (200, 300), (5000, 6000)], sorted(self.bins[50:5500]))
+
+        def test_within_and_containing_alternate_indices(self):
+            altbins = FeatureBinCollection(beginindex=1, endindex=2)
+            features = [(f[2], f[0], f[1]) for f in self._random_features(500, 17)]
+            altbins.extend(features)
+            self.assertEqual(sorted(altbins.within(2**20, 2**22)),
+                sorted(f for f in features if 2**20 <= f[1] and f[2] <= 2**22))
+            self.assertEqual(sorted(altbins.containing(2**21)),
+                sorted(f for f in features if f[1] <= 2**21 < f[2] or f[1] == 2**21))
+
     unittest.main( exit=False )
 
     print("now running doctests")
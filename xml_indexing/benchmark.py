@@ -0,0 +1,300 @@
+"""Benchmarks of the XML record indexers on generated catalogs
+
+    python benchmark.py --records 100000 --layout single --output results.json
+
+generate_catalog writes a seeded catalog in the schema of simple.xml,
+the record count, the nesting depth of each record, the size of its
+text and the layout (pretty printed or one single line) can be set.
+Every indexer then indexes the PLANT records of the same file and
+fetches the same random records, the results are written as JSON:
+
+  build_seconds, build_mb_per_second   one index build of the whole file
+  peak_memory_bytes                    tracemalloc peak of a second build,
+                                       memory maps and C buffers not counted
+  lookup_*_us                          latency of a random record fetch
+
+The line based IterParseIterator needs etree._IterParseIterator and is
+reported as skipped on python versions without it (every version after
+3.4), there the expat versus etree comparison is the one of ExpatHandler
+and ChunkedIterParseIterator. Where it runs its offsets are those of
+whole lines, on a single line catalog it reads the file at once.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as etree
+
+import etree_indexer_test
+from etree_indexer_test import ChunkedIterParseIterator, IterParseIterator
+from expat_indexing_test import ExpatHandler
+
+_NAMESPACE = "http://peptidomics.evanaparker.com"
+_WORDS = ("bloodroot", "columbine", "marigold", "trillium", "aster", "ginger",
+          "violet", "phlox", "sedum", "yarrow", "canadensis", "sanguinaria",
+          "aquilegia", "western", "mostly", "shady", "sunny", "woodland")
+_LIGHTS = ("Mostly Shady", "Shade", "Sun", "Sun or Shade", "Mostly Sunny")
+
+
+def _text(rnd, size):
+    """words adding up to about size characters"""
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+def _record(rnd, depth, text_size):
+    """the (level, line) lines of one PLANT record"""
+    lines = [(0, "<PLANT>"), (1, "<NAMES>")]
+    for n in range(rnd.randint(1, 3)):
+        lines.append((2, '<N type="common" n="{}">{}</N>'.format(n + 1, _text(rnd, text_size))))
+    lines.append((2, '<N type="botanical">{}</N>'.format(_text(rnd, text_size))))
+    lines.append((1, "</NAMES>"))
+    lines.append((1, '<ZONE value="{}" />'.format(rnd.randint(1, 9))))
+    lines.append((1, "<LIGHT>{}</LIGHT>".format(rnd.choice(_LIGHTS))))
+    lines.append((1, "<PRICE>${:.2f}</PRICE>".format(rnd.uniform(1, 20))))
+    lines.append((1, "<AVAILABILITY>{:06d}</AVAILABILITY>".format(rnd.randrange(10**6))))
+    for level in range(depth):
+        lines.append((level + 1, "<DETAILS>"))
+    lines.append((depth + 1, "<NOTE>{}</NOTE>".format(_text(rnd, text_size))))
+    for level in reversed(range(depth)):
+        lines.append((level + 1, "</DETAILS>"))
+    lines.append((0, "</PLANT>"))
+    return lines
+
+def generate_catalog(handle, records=10000, depth=1, text_size=20, layout="pretty",
+                     seed=0):
+    """write a catalog of records PLANT elements to a binary handle
+
+    depth is the number of nested DETAILS elements in each record,
+    text_size the length in characters of the name and note texts, and
+    layout "pretty" (indented, one tag per line) or "single" (the whole
+    file on one line). The same seed gives the same file.
+    """
+    if layout not in ("pretty", "single"):
+        raise ValueError("layout must be 'pretty' or 'single', not {!r}".format(layout))
+    rnd = random.Random(seed)
+    pretty = layout == "pretty"
+    newline = "\n" if pretty else ""
+    handle.write('<?xml version="1.0" encoding="utf-8" ?>{}<CATALOG xmlns="{}">'.format(
+                                                        newline, _NAMESPACE).encode("utf-8"))
+    for n in range(records):
+        if pretty:
+            lines = ["\n" + "  " * (level + 1) + line
+                     for level, line in _record(rnd, depth, text_size)]
+        else:
+            lines = [line for level, line in _record(rnd, depth, text_size)]
+        handle.write("".join(lines).encode("utf-8"))
+    handle.write("{}</CATALOG>{}".format(newline, newline).encode("utf-8"))
+
+
+class ExpatIndexer(object):
+    """ExpatHandler.build_index and get_record"""
+    name = "expat"
+
+    def __init__(self, filename):
+        self._handle = open(filename, "rb")
+        self._handler = ExpatHandler(self._handle)
+
+    def build(self):
+        return len(self._handler.build_index())
+
+    def fetch(self, i):
+        return self._handler.get_record(i)
+
+    def close(self):
+        self._handler.close()
+        self._handle.close()
+
+
+class EtreeIndexer(object):
+    """mixin of the etree iterparse indexers
+
+    Subclasses give a name and a build() filling self.offsets with the
+    (begin, end) byte ranges of the records, fetch() reads the bytes of
+    a record and parses them with etree.fromstring.
+    """
+    tag = "{{{}}}PLANT".format(_NAMESPACE)
+
+    def __init__(self, filename):
+        self._handle = open(filename, "rb")
+        self.offsets = []
+
+    def fetch(self, i):
+        begin, end = self.offsets[i]
+        handle = self._handle
+        handle.seek(begin)
+        return etree.fromstring(handle.read(end - begin))
+
+    def close(self):
+        self._handle.close()
+
+
+class ChunkedIterParseIndexer(EtreeIndexer):
+    """etree_indexer_test.ChunkedIterParseIterator, exact tag offsets"""
+    name = "chunked_iterparse"
+
+    def build(self):
+        self._handle.seek(0)
+        offsets = self.offsets = []
+        tag = self.tag
+        begin = None
+        for event, elem, tagbegin, tagend in ChunkedIterParseIterator(self._handle,
+                                                        events=("start", "end")):
+            if elem.tag == tag:
+                if event == "start":
+                    begin = tagbegin
+                else:
+                    offsets.append((begin, tagend))
+                    elem.clear()
+        return len(offsets)
+
+
+class IterParseIndexer(EtreeIndexer):
+    """etree_indexer_test.IterParseIterator, offsets of whole lines"""
+    name = "iterparse"
+
+    def build(self):
+        self._handle.seek(0)
+        offsets = self.offsets = []
+        tag = self.tag
+        begin = None
+        iterator = IterParseIterator(self._handle, events=("start", "end"), parser=None)
+        for event, elem in iterator:
+            if elem.tag == tag:
+                if event == "start":
+                    begin = iterator._old_position
+                else:
+                    offsets.append((begin, iterator.position))
+                    elem.clear()
+        return len(offsets)
+
+    @staticmethod
+    def available():
+        return etree_indexer_test._IterParseIteratorBase is not object
+
+
+INDEXERS = [ExpatIndexer, ChunkedIterParseIndexer, IterParseIndexer]
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def benchmark_indexer(indexer_class, filename, lookups=1000, seed=0):
+    """build, memory and random access measurements of one indexer
+
+    returns a dict of results, with a "skipped" reason when the indexer
+    cannot run here
+    """
+    result = {"indexer": indexer_class.name}
+    available = getattr(indexer_class, "available", None)
+    if available is not None and not available():
+        result["skipped"] = "not supported by this python version"
+        return result
+    size = os.path.getsize(filename)
+
+    indexer = indexer_class(filename)
+    try:
+        tbegin = time.perf_counter()
+        records = indexer.build()
+        elapsed = time.perf_counter() - tbegin
+        result["records"] = records
+        result["build_seconds"] = elapsed
+        result["build_mb_per_second"] = size / 1e6 / elapsed if elapsed else None
+
+        rnd = random.Random(seed)
+        latencies = []
+        for n in range(min(lookups, records) if records else 0):
+            i = rnd.randrange(records)
+            tbegin = time.perf_counter()
+            indexer.fetch(i)
+            latencies.append((time.perf_counter() - tbegin) * 1e6)
+        if latencies:
+            result["lookup_mean_us"] = sum(latencies) / len(latencies)
+            result["lookup_median_us"] = _percentile(latencies, 0.5)
+            result["lookup_p95_us"] = _percentile(latencies, 0.95)
+    finally:
+        indexer.close()
+
+    #memory is measured on a separate build, tracemalloc slows allocations
+    indexer = indexer_class(filename)
+    try:
+        tracemalloc.start()
+        indexer.build()
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        indexer.close()
+    return result
+
+def run_benchmark(records=10000, depth=1, text_size=20, layout="pretty", seed=0,
+                  lookups=1000, indexers=None, filename=None):
+    """generate a catalog and benchmark the indexers on it
+
+    The catalog is written to filename when given and kept, otherwise to
+    a temporary file that is removed afterwards.
+
+    returns a dict of the settings, the file size and a list of results
+    """
+    settings = {"records": records, "depth": depth, "text_size": text_size,
+                "layout": layout, "seed": seed, "lookups": lookups}
+    indexers = INDEXERS if indexers is None else indexers
+    if filename is None:
+        descriptor, path = tempfile.mkstemp(suffix=".xml")
+        os.close(descriptor)
+    else:
+        path = filename
+    try:
+        with open(path, "wb") as handle:
+            generate_catalog(handle, records, depth, text_size, layout, seed)
+        results = [benchmark_indexer(indexer_class, path, lookups, seed)
+                   for indexer_class in indexers]
+        size = os.path.getsize(path)
+    finally:
+        if filename is None:
+            os.remove(path)
+    return {"settings": settings, "file_size": size, "python": sys.version.split()[0],
+            "results": results}
+
+def main(argv=None):
+    names = dict((indexer_class.name, indexer_class) for indexer_class in INDEXERS)
+    parser = argparse.ArgumentParser(description="benchmark the XML record indexers")
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=1,
+                        help="nested DETAILS elements per record")
+    parser.add_argument("--text-size", type=int, default=20,
+                        help="characters of text per name and note")
+    parser.add_argument("--layout", choices=("pretty", "single"), default="pretty")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lookups", type=int, default=1000,
+                        help="random record fetches per indexer")
+    parser.add_argument("--indexers", default=",".join(names),
+                        help="comma separated, from {}".format(", ".join(names)))
+    parser.add_argument("--catalog", help="keep the generated catalog in this file")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    try:
+        indexers = [names[name] for name in args.indexers.split(",")]
+    except KeyError as error:
+        parser.error("unknown indexer {}".format(error))
+    results = run_benchmark(args.records, args.depth, args.text_size, args.layout,
+                            args.seed, args.lookups, indexers, args.catalog)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Minimal reader and writer for BGZF block compressed files
+
+BGZF, the block gzip format of samtools and tabix, is a series of gzip
+members holding at most 64 KiB of data each, the compressed size of a
+block is stored in a "BC" extra field of its gzip header. A BGZF file is
+a valid gzip file, and any position in it is addressed by a virtual
+offset
+
+    virtual_offset = block_start << 16 | offset_within_block
+
+where block_start is the byte offset of a block in the compressed file
+and offset_within_block the offset in its uncompressed data. Reaching a
+virtual offset only decompresses the block holding it.
+"""
+import struct
+import zlib
+
+#largest uncompressed block, leaves room for incompressible data
+_MAX_BLOCK_SIZE = 0xff00
+#magic, method, flags, mtime, xfl, os, xlen, BC subfield with block size - 1
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_FOOTER = struct.Struct("<II")
+#the empty block closing every BGZF file
+_EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+              b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def make_virtual_offset(block_start, within_block):
+    if not 0 <= within_block < 65536:
+        raise ValueError("offset within block {} out of range".format(within_block))
+    return block_start << 16 | within_block
+
+def split_virtual_offset(virtual_offset):
+    """(block_start, offset_within_block) of a virtual offset"""
+    return virtual_offset >> 16, virtual_offset & 0xffff
+
+
+class BgzfWriter(object):
+    """Write data to a binary handle as BGZF blocks
+
+    Data is compressed in blocks of _MAX_BLOCK_SIZE bytes, flush() ends
+    the current block early so a record can start a new block. tell()
+    gives the virtual offset of the next byte written. close() writes the
+    end of file marker block and closes the handle.
+    """
+    def __init__(self, handle, compresslevel=6):
+        self._handle = handle
+        self._compresslevel = compresslevel
+        self._buffer = b""
+
+    def write(self, data):
+        buffer = self._buffer + data
+        while len(buffer) >= _MAX_BLOCK_SIZE:
+            self._write_block(buffer[:_MAX_BLOCK_SIZE])
+            buffer = buffer[_MAX_BLOCK_SIZE:]
+        self._buffer = buffer
+
+    def tell(self):
+        return make_virtual_offset(self._handle.tell(), len(self._buffer))
+
+    def flush(self):
+        if self._buffer:
+            self._write_block(self._buffer)
+            self._buffer = b""
+        self._handle.flush()
+
+    def close(self):
+        self.flush()
+        self._handle.write(_EOF_BLOCK)
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self._compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        blocksize = _HEADER.size + len(compressed) + _FOOTER.size
+        handle = self._handle
+        handle.write(_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, blocksize - 1))
+        handle.write(compressed)
+        handle.write(_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfReader(object):
+    """Read a BGZF file from a binary handle with virtual offset seeks
+
+    seek() and tell() use virtual offsets, read() returns uncompressed
+    data. Recently used blocks are kept decompressed, up to cache_size of
+    them, so reading records lying close together decompresses each
+    block once. The underlying handle is available as fileobj.
+    """
+    def __init__(self, handle, cache_size=8):
+        self.fileobj = handle
+        self._cache_size = cache_size
+        self._cache = {}
+        self._load_block(0)
+
+    def seek(self, virtual_offset):
+        block_start, within = split_virtual_offset(virtual_offset)
+        if block_start != self._blockstart:
+            self._load_block(block_start)
+        if within > len(self._data):
+            raise ValueError("virtual offset {} lies beyond its block".format(virtual_offset))
+        self._within = within
+        return virtual_offset
+
+    def tell(self):
+        return make_virtual_offset(self._blockstart, self._within)
+
+    def read(self, size=-1):
+        parts = []
+        for virtual_offset, data in self.chunks():
+            if size >= 0 and len(data) >= size:
+                #give back the part of the block that was not asked for
+                self._within -= len(data) - size
+                parts.append(data[:size])
+                break
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def chunks(self):
+        """yield (virtual_offset, data) for the rest of each block
+
+        Iteration starts at the current position and moves it along, a
+        block is decompressed just before its data is yielded.
+        """
+        while True:
+            if self._within >= len(self._data):
+                if self._nextblock == self._blockstart:
+                    return
+                self._load_block(self._nextblock)
+                continue
+            virtual_offset = self.tell()
+            data = self._data[self._within:]
+            self._within = len(self._data)
+            yield virtual_offset, data
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load_block(self, block_start):
+        try:
+            data, nextblock = self._cache[block_start]
+        except KeyError:
+            data, nextblock = self._read_block(block_start)
+            if len(self._cache) >= self._cache_size:
+                del self._cache[next(iter(self._cache))]
+            self._cache[block_start] = data, nextblock
+        self._blockstart = block_start
+        self._nextblock = nextblock
+        self._data = data
+        self._within = 0
+
+    def _read_block(self, block_start):
+        """(data, start of the next block) of the block at block_start
+
+        At the end of the file the data is empty and the next block is
+        the same block.
+        """
+        handle = self.fileobj
+        handle.seek(block_start)
+        header = handle.read(_HEADER.size)
+        if not header:
+            return b"", block_start
+        if len(header) < _HEADER.size:
+            raise ValueError("truncated BGZF block at byte {}".format(block_start))
+        (id1, id2, method, flags, mtime, xfl, os, xlen,
+         si1, si2, slen, blocksize) = _HEADER.unpack(header)
+        if (id1, id2, method, flags & 4, si1, si2, slen) != (31, 139, 8, 4, 66, 67, 2):
+            raise ValueError("no BGZF block at byte {}".format(block_start))
+        if xlen != 6:
+            #other extra subfields precede the compressed data
+            handle.read(xlen - 6)
+        rest = handle.read(blocksize + 1 - _HEADER.size - (xlen - 6))
+        if len(rest) < _FOOTER.size:
+            raise ValueError("truncated BGZF block at byte {}".format(block_start))
+        crc, size = _FOOTER.unpack(rest[-_FOOTER.size:])
+        data = zlib.decompress(rest[:-_FOOTER.size], -15)
+        if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+            raise ValueError("corrupt BGZF block at byte {}".format(block_start))
+        return data, block_start + blocksize + 1
@@ -1,6 +1,30 @@
+from collections import deque
+import io
+import re
 import xml.etree.ElementTree as etree
+from xml.parsers.expat import ParserCreate
 
-class IterParseIterator(etree._IterParseIterator):
+# etree._IterParseIterator was dropped from the standard library after
+# python 3.4, the line based IterParseIterator can only be used where it exists
+_IterParseIteratorBase = getattr(etree, "_IterParseIterator", object)
+
+# matches the remainder of a tag up to and including its closing '>'
+# quoted attribute values may themselves contain '>' characters
+_TAG_END = re.compile(br'[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+# an entity reference, elements expanded from an internal entity get its range
+_ENTITY_REFERENCE = re.compile(br'&[^;<>&\s]+;')
+
+_fixednames = {}
+
+def _fixname(name):
+    """expat namespace names to etree {uri}local names, cached"""
+    try:
+        return _fixednames[name]
+    except KeyError:
+        fixed = _fixednames[name] = "{" + name if "}" in name else name
+        return fixed
+
+class IterParseIterator(_IterParseIteratorBase):
     """Implements the etree iterparse with indexing
     
     This works by reading one byte at a time, feeding 
@@ -11,20 +35,33 @@ class IterParseIterator(etree._IterParseIterator):
     This only generates xml tag beginnings and ends, 
     the resulting data structure must still be produced
     manually.
+    
+    The lines read for an event are kept in a line buffer,
+    read_prev_line gives them back without touching the file
+    so non-seekable streams work as well.
+    
+    It subclasses etree._IterParseIterator and cannot be used
+    on python versions without it (after 3.4).
     """
     
     def __init__(self, *args, **kwargs):
         self.tag = ""   # addition
         self._old_position = 0 # addition
         self.position = 0   # addition
+        self._linebuffer = bytearray() # addition
+        self._eventspan = (0, 0) # addition
         etree._IterParseIterator.__init__(self, *args, **kwargs)
         
     def __next__(self):
         self._old_position = self.position # addition
         currentposition = self.position # addition
+        linesbegin = None # addition
         while 1:
             for event in self._parser.read_events():
                 self.position = currentposition
+                if linesbegin is not None: # addition
+                    #later events of the same lines share their span
+                    self._eventspan = (linesbegin, len(self._linebuffer))
                 return event
             if self._parser._parser is None:
                 self.root = self._root
@@ -32,10 +69,15 @@ class IterParseIterator(etree._IterParseIterator):
                     self._file.close()
                 raise StopIteration
             # load event buffer
+            if linesbegin is None: # addition
+                #the lines of the previous events are no longer needed
+                self._clear_linebuffer()
+                linesbegin = len(self._linebuffer)
             data = self._file.readline()  # alteration
             #data = self._file.read(1)
             currentposition += len(data) # addition
             if data:
+                self._linebuffer += data # addition
                 self._parser.feed(data)
             else:
                 self._root = self._parser._close_and_return_root()
@@ -43,14 +85,218 @@ class IterParseIterator(etree._IterParseIterator):
     next = __next__
 
     def read_prev_line(self):
-        readlen = self.position - self._old_position
-        self._file.seek(-1*readlen, 1)
-        line = self._file.read(readlen)
-        assert self._file.tell() == self.position
-        return line
+        """the lines read for the last event, as a memoryview
+        
+        Events produced by the same lines give the same lines. The view
+        shares memory with the line buffer, no copy is made. While a view
+        is held the iterator fills a new buffer rather than overwriting
+        this one, use bytes(view) to keep the data anyway. Like the rest of
+        IterParseIterator it needs etree._IterParseIterator (python 3.4
+        and before).
+        """
+        begin, end = self._eventspan
+        return memoryview(self._linebuffer)[begin:end]
+
+    def _clear_linebuffer(self):
+        try:
+            del self._linebuffer[:]
+        except BufferError:
+            #a view of the buffer is still alive, leave it to its holder
+            self._linebuffer = bytearray()
+
+
+class ChunkedIterParseIterator(object):
+    """Implements an etree iterparse with exact byte offsets
+
+    The source is read in fixed size binary chunks and fed to an expat
+    parser; the elements are assembled by an etree.TreeBuilder so the
+    resulting tree is the same as the one built by etree.iterparse.
+    Reading and offsets are independent of the line layout of the file,
+    a minified single line document is indexed in the same chunks as
+    a pretty printed one.
+
+    Every event is returned as an (event, elem, begin, end) tuple where
+    [begin, end) is the exact byte range of the tag that produced it.
+    expat supplies the byte index of the opening '<' and the closing '>'
+    is found in the buffered input. Empty element tags such as
+    <ZONE value="4" /> produce a start and an end event sharing a range.
+    Elements expanded from an internal entity have no tags in the input,
+    their events are given the range of the entity reference instead.
+    raw(begin, end) gives the bytes of a tag from the input buffer as a
+    memoryview, without seeking or reading the source again. The source
+    is only read, pipes and other non-seekable streams work as well.
+    Unlike IterParseIterator this runs on every python version.
+    """
+
+    def __init__(self, source, events=("end",), chunk_size=65536,
+                 close_source=False):
+        self._file = source
+        self._close_file = close_source
+        self._chunk_size = chunk_size
+        self._events = frozenset(events)
+        self._pending = deque()
+        self.root = None
+
+        self._builder = etree.TreeBuilder()
+        parser = self._parser = ParserCreate(namespace_separator="}")
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._builder.data
+        parser.buffer_text = True
+
+        #offsets are relative to where the source was positioned, a pipe
+        #or another non-seekable source is read from its start
+        try:
+            self._baseposition = source.tell()
+        except (OSError, io.UnsupportedOperation):
+            self._baseposition = 0
+        self._buffer = bytearray()
+        self._bufferstart = self._baseposition
+        self._laststart = (None, 0, 0)
+        self._lastend = self._baseposition
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        pending = self._pending
+        while not pending:
+            if self._parser is None:
+                raise StopIteration
+            self._read_chunk()
+        return pending.popleft()
+
+    next = __next__
+
+    def raw(self, begin, end):
+        """the bytes of an event range as a memoryview of the input buffer
+        
+        The ranges of all events returned since the last call to next()
+        are available. The view shares memory with the buffer, while it
+        is held the iterator moves on to a new buffer instead of reusing
+        this one, use bytes(view) to keep the data anyway.
+        """
+        local = begin - self._bufferstart
+        localend = end - self._bufferstart
+        if local < 0 or localend > len(self._buffer) or local > localend:
+            raise ValueError("range [{}, {}) is no longer buffered".format(begin, end))
+        return memoryview(self._buffer)[local:localend]
+
+    def _read_chunk(self):
+        """feed one chunk to the parser, the buffer keeps unconsumed input"""
+        data = self._file.read(self._chunk_size)
+        keep = self._lastend - self._bufferstart
+        try:
+            del self._buffer[:keep]
+            self._buffer += data
+        except BufferError:
+            #a view of the buffer is still alive, leave it to its holder
+            self._buffer = self._buffer[keep:] + data
+        self._bufferstart = self._lastend
+        if data:
+            self._parser.Parse(data, False)
+        else:
+            self._parser.Parse(b"", True)
+            self.root = self._builder.close()
+            self._parser = None
+            if self._close_file:
+                self._file.close()
+
+    def _tag_span(self, begin):
+        local = begin - self._bufferstart
+        buffer = self._buffer
+        if buffer[local:local+1] == b"<":
+            match = _TAG_END.match(buffer, local + 1)
+        else:
+            match = _ENTITY_REFERENCE.match(buffer, local)
+        if match is None:
+            raise ValueError("no tag or entity reference at byte {}".format(begin))
+        end = match.end() + self._bufferstart
+        self._lastend = end
+        return begin, end
+
+    def _start(self, name, attrs):
+        tag = _fixname(name)
+        attrib = dict((_fixname(key), value) for key, value in attrs.items())
+        elem = self._builder.start(tag, attrib)
+        begin, end = self._tag_span(self._parser.CurrentByteIndex + self._baseposition)
+        local = end - self._bufferstart
+        if self._buffer[local-2:local] == b"/>":
+            #an empty element tag, the end event will share this range
+            self._laststart = (elem, begin, end)
+        else:
+            self._laststart = (None, begin, end)
+        if "start" in self._events:
+            self._pending.append(("start", elem, begin, end))
+
+    def _end(self, name):
+        elem = self._builder.end(_fixname(name))
+        if self._laststart[0] is elem:
+            begin, end = self._laststart[1:]
+        else:
+            begin, end = self._tag_span(self._parser.CurrentByteIndex + self._baseposition)
+        if "end" in self._events:
+            self._pending.append(("end", elem, begin, end))
 
 
 if __name__ == "__main__":
+    import os
+    import unittest
+
+    class TestChunkedIterParseIterator(unittest.TestCase):
+        def _events(self, data, chunk_size):
+            iterator = ChunkedIterParseIterator(io.BytesIO(data), events=("start", "end"),
+                                                chunk_size=chunk_size)
+            return [(event, elem.tag, iterator.raw(begin, end).tobytes())
+                    for event, elem, begin, end in iterator]
+
+        def test_entity_elements(self):
+            data = (b'<!DOCTYPE a [<!ENTITY e "<b>x<c/></b>">]>'
+                    b'<a>&e;<d>&amp;</d></a>')
+            for chunk_size in (1, 7, 65536):
+                self.assertEqual(self._events(data, chunk_size),
+                                 [("start", "a", b"<a>"), ("start", "b", b"&e;"),
+                                  ("start", "c", b"&e;"), ("end", "c", b"&e;"),
+                                  ("end", "b", b"&e;"), ("start", "d", b"<d>"),
+                                  ("end", "d", b"</d>"), ("end", "a", b"</a>")])
+
+        def test_non_seekable_sources(self):
+            data = b'<a><b x="1"/>' + b"<c>text</c>" * 1000 + b"</a>"
+            expected = [(event, elem.tag, begin, end) for event, elem, begin, end
+                        in ChunkedIterParseIterator(io.BytesIO(data), events=("start", "end"),
+                                                    chunk_size=100)]
+
+            class Stream(io.RawIOBase):
+                """readable only, tell() raises io.UnsupportedOperation"""
+                def __init__(self, data):
+                    self._data = io.BytesIO(data)
+                def readable(self):
+                    return True
+                def readinto(self, buffer):
+                    return self._data.readinto(buffer)
+
+            reader, writer = os.pipe()
+            with os.fdopen(writer, "wb") as handle:
+                handle.write(data)
+            #tell() on a pipe raises OSError (illegal seek)
+            with os.fdopen(reader, "rb") as pipe:
+                for source in (pipe, Stream(data)):
+                    events = [(event, elem.tag, begin, end) for event, elem, begin, end
+                              in ChunkedIterParseIterator(source, events=("start", "end"),
+                                                          chunk_size=100)]
+                    self.assertEqual(events, expected)
+
+    unittest.main(exit=False)
+
+    #exact offsets from the chunked indexer
+    xmlfile = open("simple.xml", 'rb')
+    iterator = ChunkedIterParseIterator(xmlfile, events=('start', 'end'), close_source=True)
+    for event, elem, begin, end in iterator:
+        print("event {}; elem {} @ [{}, {}) {!r}".format(event, elem.tag, begin, end,
+                                                        iterator.raw(begin, end).tobytes()))
+    if _IterParseIteratorBase is object:
+        raise SystemExit("line based IterParseIterator needs etree._IterParseIterator")
+
     #initialize xml file
     xmlfile = open("simple.xml", 'rb')
     a = IterParseIterator(xmlfile, events=('start', 'end'), parser=None, close_source=True)
@@ -59,7 +305,7 @@ if __name__ == "__main__":
     while True:
         out = next(a)
         line = a.read_prev_line()
-        print("foundline;  {}".format(repr(line)))
+        print("foundline;  {}".format(repr(line.tobytes())))
         print("current event {}; elem {} @ {}\n".format(out[0], out[1].tag, a._file.tell()))
         b = input("press any key to end iteration: ")
         if b:
@@ -1,7 +1,34 @@
-from xml.parsers.expat import ParserCreate
+from array import array
+from collections import deque
+from bisect import bisect_left, bisect_right
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import zlib
+from xml.parsers.expat import ExpatError, ParserCreate, errors
+from xml.sax.saxutils import quoteattr
+
+from bgzf import BgzfReader, split_virtual_offset
+from etree_indexer_test import _TAG_END, _fixname
+
+# byte range indexing starts mid-document, records are parsed as children
+# of this synthetic root so that consecutive records form one document
+_RANGE_ROOT = b"<_RANGE_ROOT>"
+
+# layout version of the SQLite sidecar files written by save_index
+_SIDECAR_VERSION = "2"
+#bytes at the head and the tail of a file checksummed for its signature
+_SIGNATURE_BLOCKSIZE = 65536
 
 class Element(object):
     """A simple to use element class for indexing"""
+    __slots__ = ("parent", "name", "text", "attributes", "children",
+                 "indexbegin", "indexend", "nameindex")
+
     def __init__(self, name, begin=None, end=None):
         self.parent = None
         self.name = name
@@ -10,12 +37,17 @@ class Element(object):
         self.children = []
         self.indexbegin = begin
         self.indexend = end
+        #ExpatHandler fills this {name: [elements]} map of all descendants
+        #for record and root elements while they are parsed
+        self.nameindex = None
         
     def add_child(self, child):
         child.parent = self
         self.children.append(child)
     
     def get_all_children_by_name(self,name):
+        if self.nameindex is not None:
+            return list(self.nameindex.get(name, ()))
         validchildren = []
         for child in self.children:
             if child.name == name:
@@ -23,6 +55,34 @@ class Element(object):
             validchildren.extend(child.get_all_children_by_name(name))
         return validchildren
             
+    def findall(self, path):
+        """all descendants matching a simple path, in document order
+        
+        The path is a '/' separated list of tag names relative to this
+        element, each optionally followed by an [@attribute] or
+        [@attribute=value] predicate, for example "NAMES/N[@type=common]".
+        Candidates for the last step are taken from the name index and
+        the other steps are checked on their parents.
+        """
+        steps = _compile_path(path)
+        found = []
+        for elem in self.get_all_children_by_name(steps[-1][0]):
+            candidate = elem
+            for name, attribute, value in reversed(steps):
+                if candidate is None or candidate.name != name or \
+                   not _attribute_matches(candidate.attributes, attribute, value):
+                    break
+                candidate = candidate.parent
+            else:
+                if candidate is self:
+                    found.append(elem)
+        return found
+
+    def find(self, path):
+        """the first descendant matching a simple path or None, see findall"""
+        found = self.findall(path)
+        return found[0] if found else None
+
     def first_child(self):
         if not self.children:
             return None
@@ -40,6 +100,193 @@ class Element(object):
         else:
             return self.parent.depth() + 1
 
+# one step of an Element.findall path: name[@attribute=value]
+_PATH_STEP = re.compile(r"""^((?:\{[^}]*\})?[^/\[\]@={}]+)"""
+                        r"""(?:\[@([^=\]]+)(?:=(["']?)(.*?)\3)?\])?$""")
+_compiled_paths = {}
+#a "/" inside a {uri} is not a step separator
+_PATH_SEPARATOR = re.compile(r"/(?![^{]*\})")
+
+def _compile_path(path):
+    """split a findall path in (name, attribute, value) steps, cached"""
+    try:
+        return _compiled_paths[path]
+    except KeyError:
+        pass
+    steps = []
+    for step in _PATH_SEPARATOR.split(path):
+        match = _PATH_STEP.match(step.strip())
+        if match is None:
+            raise ValueError("invalid path step {!r} in {!r}".format(step, path))
+        name, attribute, quote, value = match.groups()
+        steps.append((name, attribute, value))
+    _compiled_paths[path] = steps
+    return steps
+
+def _attribute_matches(attributes, attribute, value):
+    if attribute is None:
+        return True
+    if not attributes or attribute not in attributes:
+        return False
+    return value is None or attributes[attribute] == value
+
+def _compile_keyfields(keyfields):
+    """(field, steps, attribute) for each key field path of ExpatHandler
+    
+    A key path is a findall path relative to the record, the text of the
+    matching elements is the key. A final "@attribute" step takes the
+    attribute value instead, for example "ZONE/@value" or "@id".
+    """
+    compiled = []
+    for field in sorted(keyfields or ()):
+        path = keyfields[field]
+        attribute = None
+        steps = _PATH_SEPARATOR.split(path)
+        if steps[-1].startswith("@"):
+            path, attribute = "/".join(steps[:-1]), steps[-1][1:]
+        steps = _compile_path(path) if path else []
+        compiled.append((field, steps, attribute))
+    return compiled
+
+class RecordIndex(object):
+    """A compact index of record byte offsets
+
+    Each record is stored as a [begin, end) byte range in two parallel
+    arrays of 64 bit integers, the record number is the position in the
+    arrays. Iteration and indexing give (record_number, begin, end) tuples.
+    The types array holds the record type number of every record.
+    """
+    def __init__(self, begins=None, ends=None, types=None):
+        self.begins = array("q") if begins is None else begins
+        self.ends = array("q") if ends is None else ends
+        self.types = array("H", [0]) * len(self.begins) if types is None else types
+        assert len(self.begins) == len(self.ends) == len(self.types)
+        #secondary indices, {key field: KeyIndex}
+        self.keys = {}
+
+    def extend(self, other):
+        """append the records and keys of another RecordIndex"""
+        offset = len(self)
+        self.begins.extend(other.begins)
+        self.ends.extend(other.ends)
+        self.types.extend(other.types)
+        for field, keyindex in other.keys.items():
+            if field not in self.keys:
+                self.keys[field] = KeyIndex()
+            self.keys[field].extend(keyindex, offset)
+
+    def append(self, begin, end, recordtype=0):
+        self.begins.append(begin)
+        self.ends.append(end)
+        self.types.append(recordtype)
+
+    def __len__(self):
+        return len(self.begins)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.begins)
+        return i, self.begins[i], self.ends[i]
+
+    def __iter__(self):
+        return ((i, begin, end) for i, (begin, end) in
+                enumerate(zip(self.begins, self.ends)))
+
+    def __repr__(self):
+        return "< RecordIndex records={} >".format(len(self))
+
+class KeyIndex(object):
+    """Maps the values of one key field to record numbers
+    
+    Keys are kept as a sorted list next to an array of record numbers,
+    sorting is deferred until the first lookup. Lookups return record
+    numbers in key order without repeats.
+    """
+    def __init__(self, keys=None, records=None):
+        self.keys = [] if keys is None else keys
+        self.records = array("q") if records is None else records
+        self._sorted = True
+
+    def add(self, key, record):
+        self.keys.append(key)
+        self.records.append(record)
+        self._sorted = False
+
+    def extend(self, other, offset=0):
+        self.keys.extend(other.keys)
+        self.records.extend(record + offset for record in other.records)
+        self._sorted = False
+
+    def sort(self):
+        pairs = sorted(zip(self.keys, self.records))
+        self.keys = [key for key, record in pairs]
+        self.records = array("q", [record for key, record in pairs])
+        self._sorted = True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return bool(self.exact(key))
+
+    def exact(self, key):
+        """record numbers with this key"""
+        return self._records_between(key, key, True)
+
+    def prefix(self, prefix):
+        """record numbers with a key starting with prefix"""
+        if not self._sorted:
+            self.sort()
+        keys = self.keys
+        first = bisect_left(keys, prefix)
+        last = first
+        while last < len(keys) and keys[last].startswith(prefix):
+            last += 1
+        return self._unique_records(first, last)
+
+    def range(self, low, high):
+        """record numbers with low <= key < high"""
+        return self._records_between(low, high, False)
+
+    def _records_between(self, low, high, inclusive):
+        if not self._sorted:
+            self.sort()
+        first = bisect_left(self.keys, low)
+        if inclusive:
+            last = bisect_right(self.keys, high)
+        else:
+            last = bisect_left(self.keys, high)
+        return self._unique_records(first, last)
+
+    def _unique_records(self, first, last):
+        seen = set()
+        found = []
+        for record in self.records[first:last]:
+            if record not in seen:
+                seen.add(record)
+                found.append(record)
+        return found
+
+class RecordType(object):
+    """One kind of record indexed by ExpatHandler
+    
+    tag is the name of the record element, namestoparse the names of the
+    elements copied into the Element tree of a record (the record element
+    itself always is) and keyfields the {field: path} record values that
+    build_index puts in the secondary index. Key fields sharing a field
+    name across record types share one KeyIndex. With namespace handling
+    turned on names are written as {uri}local, the same as in ElementTree.
+    """
+    __slots__ = ("tag", "namestoparse", "keyfields")
+
+    def __init__(self, tag, namestoparse=(), keyfields=None):
+        self.tag = tag
+        self.namestoparse = list(namestoparse)
+        self.keyfields = dict(keyfields or {})
+
+    def __repr__(self):
+        return "< RecordType tag={} >".format(self.tag)
+
 class ExpatHandler(object):
     """ExpatHandler class will return an indexed Element tree
     
@@ -48,6 +295,21 @@ class ExpatHandler(object):
     having a different identity. The namestoparse list contains tags
     that will be extracted into the element tree.
     
+    The keyfields dict names values of each record (element text or
+    attributes, given as paths such as "NAMES/N[@type=common]" or
+    "ZONE/@value") that build_index collects in a secondary index so
+    that records can be fetched by content with lookup().
+    
+    Files holding several kinds of records are indexed in one pass by
+    giving a list of RecordType in place of targetfield, namestoparse
+    and keyfields. With namespaces turned on, names are matched as
+    {uri}local and the namespaces declared before the first record are
+    re-declared whenever a record is parsed on its own.
+    
+    A BGZF compressed file is read through a bgzf.BgzfReader handle, the
+    index and Element positions then hold virtual offsets and fetching a
+    record only decompresses the blocks it spans.
+    
     ExpatHandler assumes compilant well formmated XML, several types
     of formatting errors will result in difficult to decipher 
     errors while other sorts of errors will not be detected. Best
@@ -55,94 +317,1381 @@ class ExpatHandler(object):
     validation of data.
     """
     
-    def __init__(self, handle, parser_class=ParserCreate):
+    def __init__(self, handle, parser_class=ParserCreate, index_filename=None,
+                 verbose=False, keyfields=None, targetfield="PLANT",
+                 namestoparse=None, recordtypes=None, namespaces=False):
         #set up parser
         self._handle = handle
         self._parser_class = parser_class
+        #{field: path} of record values indexed by build_index, see lookup
+        self.keyfields = dict(keyfields or {})
+        #print every parsed start and end tag, only useful for debugging
+        self.verbose = verbose
+        #sidecar file holding the record index between runs, see save_index
+        self.index_filename = index_filename
         
-        self.targetfield = "PLANT"
-        self.namestoparse = ["PLANT", "NAMES", "N", "ZONE", "PRICE"] 
+        self.targetfield = targetfield
+        if namestoparse is None:
+            namestoparse = ["PLANT", "NAMES", "N", "ZONE", "PRICE"] 
+        self.namestoparse = list(namestoparse)
+        #when given, these RecordTypes replace the three settings above
+        self.recordtypes = list(recordtypes or [])
+        self.namespaces = namespaces
+        self.index = None
+        self._mmap = None
+        self._nsdeclarations = None
+        #positions are translated to virtual offsets, see _read_chunks
+        self._bgzf = isinstance(handle, BgzfReader)
     
     def parse_from_position(self, position=0):
         handle = self._handle
-        #make the parser
-        parser = self._parser = self._parser_class()
+        handle.seek(position)
+        parser = self._setup_parser(0 if self._bgzf else position)
+        try:
+            for data in self._read_chunks(65536):
+                self._feed(parser, data)
+        except StopIteration:
+            return self._virtual_tree(self.rootelem)
+        
+        #A return should have happened at this point
+        raise ValueError("Check that file contains target element")
+
+    def get_record(self, i):
+        """parse record i of the index from its own bytes only
+        
+        The file is memory mapped once and the byte range of the record
+        is handed to a fresh parser as a memoryview slice of the map, so
+        nothing outside the record is read and a lookup costs the same
+        wherever the record sits in the file. A BGZF file is read from the
+        virtual offset of the record up to its closing tag instead. When no
+        index exists it is loaded from the sidecar file or built with
+        build_index().
+        
+        returns the record Element
+        """
+        record_number, begin, end = self._get_index()[i]
+        prefix = self._synthetic_root()
+        try:
+            if self._bgzf:
+                self._handle.seek(begin)
+                parser = self._setup_parser(0, prefix)
+                for data in self._read_chunks(65536):
+                    self._feed(parser, data)
+            else:
+                view = memoryview(self._mapped_file())[begin:end]
+                parser = self._setup_parser(begin, prefix)
+                #the whole record is at hand, closing tags are found in the map
+                self._buffer = view
+                self._bufferstart = len(prefix)
+                try:
+                    parser.Parse(view, True)
+                finally:
+                    self._buffer = bytearray()
+                    view.release()
+        except StopIteration:
+            return self._virtual_tree(self.rootelem).first_child()
+        raise ValueError("record {} does not end with its closing tag".format(
+                                                                record_number))
+
+    __getitem__ = get_record
+
+    def iter_records(self, chunk_size=65536):
+        """yield (record, begin, end) for every record of the file, in order
+        
+        The file is fed to one parser in chunk_size blocks and each record
+        Element is handed out as soon as its closing tag is parsed, then
+        dropped by the handler, so memory use does not grow with the file.
+        No index is needed or built. Elements outside of records are not
+        kept. The handler parses one stream at a time, get_record and
+        parse_from_position must not be used while iterating.
+        """
+        self._handle.seek(0)
+        parser = self._setup_parser(0)
+        self._records = records = deque()
+        self._parsednames = frozenset(self._recordtags)
+        try:
+            for data in self._read_chunks(chunk_size):
+                self._feed(parser, data)
+                while records:
+                    yield records.popleft()
+            parser.Parse(b"", True)
+            while records:
+                yield records.popleft()
+        finally:
+            self._records = None
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def record_numbers(self, tag):
+        """the numbers of the records of one record type, in file order"""
+        number = [recordtype.tag for recordtype in self._record_types()].index(tag)
+        return [i for i, recordtype in enumerate(self._get_index().types)
+                if recordtype == number]
+
+    def key_index(self, field):
+        """the KeyIndex of a key field, for prefix and range lookups"""
+        return self._get_index().keys[field]
+
+    def lookup(self, field, key):
+        """the records whose key field has the value key, as Elements"""
+        return [self.get_record(i) for i in self.key_index(field).exact(key)]
+
+    def _get_index(self):
+        """the record index, loaded from the sidecar file or built once"""
+        if self.index is None and self.load_index() is None:
+            if self.index_filename is not None:
+                self.update_index()
+            else:
+                self.build_index()
+        return self.index
+
+    def save_index(self, index_filename=None):
+        """write the record index to a SQLite sidecar file
+        
+        The offset arrays are stored as blobs next to the record type
+        settings and the signature of the indexed file (size, modification
+        time and crc32 checksums of its first and last blocks).
+        build_index() is called first when no index exists.
+        """
+        index_filename = index_filename or self.index_filename
+        if index_filename is None:
+            raise ValueError("no sidecar index file name given")
+        if self.index is None:
+            self.build_index()
+        index = self.index
+        
+        meta_data = [("version", _SIDECAR_VERSION),
+                     ("recordtypes", self._index_signature()),
+                     ("byteorder", sys.byteorder),
+                     ("count", str(len(index)))]
+        if self.namespaces:
+            meta_data.append(("namespace_declarations",
+                              json.dumps(self._namespace_declarations())))
+        meta_data.extend(zip(("size", "mtime", "head_crc32", "tail_crc32"),
+                             self._file_signature()))
+        if len(index):
+            record_number, begin, end = index[-1]
+            meta_data.append(("last_record_crc32", str(zlib.crc32(
+                                  self._record_bytes(begin, end)) & 0xffffffff)))
+        con = sqlite3.connect(index_filename)
+        try:
+            with con:
+                con.execute("DROP TABLE IF EXISTS meta_data")
+                con.execute("DROP TABLE IF EXISTS offset_data")
+                con.execute("DROP TABLE IF EXISTS key_data")
+                con.execute("CREATE TABLE meta_data (key TEXT PRIMARY KEY, value TEXT)")
+                con.execute("CREATE TABLE offset_data (name TEXT PRIMARY KEY, data BLOB)")
+                con.execute("CREATE TABLE key_data (field TEXT PRIMARY KEY, "
+                            "keys BLOB, records BLOB)")
+                con.executemany("INSERT INTO meta_data VALUES (?, ?)", meta_data)
+                con.executemany("INSERT INTO offset_data VALUES (?, ?)",
+                                [("begins", sqlite3.Binary(index.begins.tobytes())),
+                                 ("ends", sqlite3.Binary(index.ends.tobytes())),
+                                 ("types", sqlite3.Binary(index.types.tobytes()))])
+                #sorted keys are stored NUL separated, NUL cannot occur in XML
+                for field, keyindex in index.keys.items():
+                    keyindex.sort()
+                    keys = "\0".join(keyindex.keys).encode("utf-8")
+                    con.execute("INSERT INTO key_data VALUES (?, ?, ?)",
+                                (field, sqlite3.Binary(keys),
+                                 sqlite3.Binary(keyindex.records.tobytes())))
+        finally:
+            con.close()
+
+    def load_index(self, index_filename=None):
+        """load the record index from a sidecar file written by save_index
+        
+        The sidecar is only trusted when it was made with the same record
+        type settings and the signature of the file still matches, a
+        missing, unreadable or stale sidecar is ignored.
+        
+        returns the RecordIndex (also kept as self.index) or None
+        """
+        sidecar = self._read_sidecar(index_filename or self.index_filename)
+        if sidecar is None or _stored_signature(sidecar[0]) != self._file_signature():
+            return None
+        return self._use_sidecar(*sidecar)
+
+    def update_index(self, index_filename=None, chunk_size=65536):
+        """bring the sidecar index up to date with the file and save it
+        
+        When the file only grew since the sidecar was saved and both its
+        last indexed record and its old head (up to 64 KiB) are unchanged
+        (same offsets, same crc32 of their bytes), the file is parsed from
+        the end of that record on and the new records are appended, so the
+        cost follows the amount of new data.
+        Records are usually added before the closing tag of the root
+        element. Any other change, or new records placed elsewhere than at
+        the end of the root element, rebuilds the whole index.
+        
+        returns the RecordIndex (also kept as self.index)
+        """
+        index_filename = index_filename or self.index_filename
+        if index_filename is None:
+            raise ValueError("no sidecar index file name given")
+        sidecar = self._read_sidecar(index_filename)
+        signature = self._file_signature()
+        if sidecar is not None and _stored_signature(sidecar[0]) == signature:
+            return self._use_sidecar(*sidecar)
+        complete = False
+        if sidecar is not None and self._only_appended(sidecar[0], sidecar[1], signature):
+            meta_data, index = sidecar
+            appended, complete = self._index_from(index.ends[-1], None, chunk_size)
+        if complete:
+            index.extend(appended)
+            self._use_sidecar(meta_data, index)
+        else:
+            self.build_index(chunk_size)
+        self.save_index(index_filename)
+        return self.index
+
+    def _only_appended(self, meta_data, index, signature):
+        """whether data was only added after the last record of a sidecar"""
+        size, mtime, head, tail = signature
+        oldsize = int(meta_data["size"])
+        if not len(index) or int(size) <= oldsize:
+            return False
+        if oldsize < _SIGNATURE_BLOCKSIZE:
+            #the stored checksum covers the whole old file
+            handle = self._handle.fileobj if self._bgzf else self._handle
+            handle.seek(0)
+            head = str(zlib.crc32(handle.read(oldsize)) & 0xffffffff)
+        if head != meta_data["head_crc32"]:
+            return False
+        record_number, begin, end = index[-1]
+        try:
+            crc = zlib.crc32(self._record_bytes(begin, end)) & 0xffffffff
+        except (ValueError, zlib.error):
+            #a rewritten BGZF file may have no block at the old offset
+            return False
+        return meta_data.get("last_record_crc32") == str(crc)
+
+    def _read_sidecar(self, index_filename):
+        """(meta_data, RecordIndex) of a sidecar made with the same record
+        type settings, or None"""
+        if index_filename is None or not os.path.isfile(index_filename):
+            return None
+        con = sqlite3.connect(index_filename)
+        try:
+            meta_data = dict(con.execute("SELECT key, value FROM meta_data"))
+            if meta_data.get("version") != _SIDECAR_VERSION or \
+               meta_data.get("recordtypes") != self._index_signature():
+                return None
+            offset_data = dict(con.execute("SELECT name, data FROM offset_data"))
+            key_data = list(con.execute("SELECT field, keys, records FROM key_data"))
+        except sqlite3.DatabaseError:
+            return None
+        finally:
+            con.close()
+        
+        swap = meta_data["byteorder"] != sys.byteorder
+        offsets = {}
+        for name, typecode in (("begins", "q"), ("ends", "q"), ("types", "H")):
+            offsets[name] = array(typecode)
+            offsets[name].frombytes(offset_data[name])
+            if swap:
+                offsets[name].byteswap()
+        index = RecordIndex(offsets["begins"], offsets["ends"], offsets["types"])
+        for field, keys, records in key_data:
+            recordarray = array("q")
+            recordarray.frombytes(records)
+            if swap:
+                recordarray.byteswap()
+            keys = bytes(keys).decode("utf-8").split("\0") if recordarray else []
+            index.keys[field] = KeyIndex(keys, recordarray)
+        return meta_data, index
+
+    def _use_sidecar(self, meta_data, index):
+        if "namespace_declarations" in meta_data:
+            self._nsdeclarations = [tuple(declaration) for declaration in
+                                json.loads(meta_data["namespace_declarations"])]
+        self.index = index
+        return self.index
+
+    def _index_signature(self):
+        """the settings an index depends on, besides the file itself"""
+        return json.dumps({"namespaces": bool(self.namespaces),
+                           "recordtypes": [[recordtype.tag, sorted(recordtype.keyfields.items())]
+                                           for recordtype in self._record_types()]},
+                          sort_keys=True)
+
+    def _file_signature(self, blocksize=_SIGNATURE_BLOCKSIZE):
+        """size, mtime and head/tail crc32 of the file, as strings"""
+        handle = self._handle.fileobj if self._bgzf else self._handle
+        stat = os.fstat(handle.fileno())
+        size = stat.st_size
+        handle.seek(0)
+        head = zlib.crc32(handle.read(blocksize)) & 0xffffffff
+        handle.seek(max(0, size - blocksize))
+        tail = zlib.crc32(handle.read(blocksize)) & 0xffffffff
+        return str(size), repr(stat.st_mtime), str(head), str(tail)
+
+    def _record_bytes(self, begin, end):
+        """the bytes of the file between two index offsets"""
+        if not self._bgzf:
+            return self._mapped_file()[begin:end]
+        handle = self._handle
+        handle.seek(begin)
+        endblock, endwithin = split_virtual_offset(end)
+        parts = []
+        for virtual_offset, data in handle.chunks():
+            block, within = split_virtual_offset(virtual_offset)
+            if block == endblock:
+                parts.append(data[:endwithin - within])
+                break
+            parts.append(data)
+        return b"".join(parts)
+
+    def close(self):
+        """release the memory map used by get_record"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _mapped_file(self):
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _read_chunks(self, chunk_size):
+        """yield the data of the file from the handle position, in chunks
+        
+        A BgzfReader is read block by block and the virtual offset of each
+        block is noted, so that _virtual_offset can translate the parser
+        positions of the data read.
+        """
+        handle = self._handle
+        if not self._bgzf:
+            while True:
+                data = handle.read(chunk_size)
+                if not data:
+                    return
+                yield data
+        starts = self._chunkstarts = array("q")
+        virtual_offsets = self._chunkoffsets = array("q")
+        position = 0
+        for virtual_offset, data in handle.chunks():
+            starts.append(position)
+            virtual_offsets.append(virtual_offset)
+            position += len(data)
+            yield data
+
+    def _virtual_offset(self, position):
+        """the virtual offset of a position in the data of _read_chunks"""
+        k = bisect_right(self._chunkstarts, position) - 1
+        return self._chunkoffsets[k] + position - self._chunkstarts[k]
+
+    def _virtual_tree(self, element):
+        """for a BGZF file, turn the positions of an Element tree into
+        virtual offsets, returns element"""
+        if self._bgzf:
+            elements = [element]
+            while elements:
+                current = elements.pop()
+                current.indexbegin = self._virtual_offset(current.indexbegin)
+                if current.indexend is not None and current.indexend is not True:
+                    current.indexend = self._virtual_offset(current.indexend)
+                elements.extend(current.children)
+        return element
+
+    def _record_types(self):
+        """the configured RecordTypes, by default one made of targetfield,
+        namestoparse and keyfields"""
+        if self.recordtypes:
+            return self.recordtypes
+        return [RecordType(self.targetfield, self.namestoparse, self.keyfields)]
+
+    def _compile_record_types(self):
+        """build the lookup tables used by the handlers
+        
+        _recordtags maps a record tag to its record type number, the
+        parsed names and compiled key fields are lists by type number.
+        """
+        recordtypes = self._record_types()
+        self._recordtags = dict((recordtype.tag, number)
+                                for number, recordtype in enumerate(recordtypes))
+        self._typeparsednames = [frozenset(recordtype.namestoparse) | frozenset([recordtype.tag])
+                                 for recordtype in recordtypes]
+        self._typekeyfields = [_compile_keyfields(recordtype.keyfields)
+                               for recordtype in recordtypes]
+        self._recordtag = None
+        return recordtypes
+
+    def _new_parser(self):
+        if self.namespaces:
+            parser = self._parser_class(namespace_separator="}")
+        else:
+            parser = self._parser_class()
+        self._parser = parser
+        return parser
+
+    def _qualify_attributes(self, attrs):
+        return dict((_fixname(key), value) for key, value in attrs.items())
+
+    def _namespace_declarations(self):
+        """[(prefix, uri)] of the namespaces declared before the first record
+        
+        The default namespace has an empty prefix. The file head is parsed
+        once, the result is also stored in the sidecar file.
+        """
+        if self._nsdeclarations is None:
+            self._declarations = {}
+            parser = self._new_parser()
+            self._compile_record_types()
+            parser.StartElementHandler = self._declaration_start_element
+            parser.StartNamespaceDeclHandler = self._namespace_declaration
+            handle = self._handle
+            handle.seek(0)
+            try:
+                while True:
+                    data = handle.read(65536)
+                    parser.Parse(data, not data)
+                    if not data:
+                        break
+            except StopIteration:
+                pass
+            self._nsdeclarations = sorted(self._declarations.items())
+        return self._nsdeclarations
+
+    def _declaration_start_element(self, name, attrs):
+        if _fixname(name) in self._recordtags:
+            raise StopIteration()
+
+    def _namespace_declaration(self, prefix, uri):
+        self._declarations[prefix or ""] = uri
+
+    def _synthetic_root(self):
+        """start tag of the synthetic root wrapping records parsed on their own
+        
+        Without namespace handling no wrapping is needed and b"" is returned.
+        """
+        if not self.namespaces:
+            return b""
+        declarations = "".join(" xmlns{}={}".format(":" + prefix if prefix else "",
+                                                    quoteattr(uri))
+                               for prefix, uri in self._namespace_declarations())
+        return _RANGE_ROOT[:-1] + declarations.encode("utf-8") + b">"
+
+    def _setup_parser(self, position, prefix=b""):
+        """make a parser building an Element tree for bytes starting at position
+        
+        A prefix (a synthetic root start tag) is fed to the parser first, it
+        does not count in the byte offsets.
+        """
+        parser = self._new_parser()
         parser.StartElementHandler = self.start_element
         parser.EndElementHandler = self.end_element
         parser.CharacterDataHandler = self.char_data
-        handle.seek(position)
-        self.baseposition = position
+        parser.buffer_text = True
+        self.baseposition = position - len(prefix)
         
         rootelem = Element(name="ROOT", begin=position)
+        rootelem.nameindex = {}
+        self._nameindexes = [rootelem.nameindex]
         self.rootelem = rootelem
         self.currentelem = rootelem
         self.target_tag_met = False
+        self.savetext = False
+        self._compile_record_types()
+        #outside of records every record type's names are parsed
+        self._parsednames = frozenset().union(*self._typeparsednames)
+        self._depth = 0
+        #text is collected per open element and joined once it is finished
+        self._textparts = []
+        self._textstack = [self._textparts]
+        self._textrun = False
+        #open elements of the record tag, nested records included
+        self._recorddepth = 0
+        #finished records when streaming, see iter_records
+        self._records = None
         
         self.tags = {}
         self.tagcounts = {}
+        self._buffer = bytearray()
+        self._bufferstart = 0
+        if prefix:
+            self._feed(parser, prefix)
+        return parser
+
+    def _feed(self, parser, data):
+        """parse data, keeping the input from the last tag start on
+        
+        Expat gives the position of a closing tag but not its length, the
+        kept input lets _record_end find its closing '>'. A tag cannot
+        hold a '<', so a tag ending in data starts in data or at the last
+        '<' fed before.
+        """
+        buffer = self._buffer
+        keep = buffer.rfind(b"<")
+        if keep < 0:
+            keep = len(buffer)
+        del buffer[:keep]
+        self._bufferstart += keep
+        buffer += data
+        parser.Parse(data, False)
+
+    def _tag_end(self, index):
+        """parser index of the byte after the tag starting at parser index"""
+        local = index - self._bufferstart
+        return _TAG_END.match(self._buffer, local + 1).end() + self._bufferstart
+
+    def _record_end(self, begin):
+        """the position after the closing tag of the record beginning at
+        begin, called from its end element handler
+        
+        Closing tags may hold white space before their '>'. For an empty
+        element tag expat reports the end already after the tag.
+        """
+        index = self._parser.CurrentByteIndex
+        start = begin - self.baseposition
+        if start >= self._bufferstart and self._tag_end(start) == index and \
+           self._buffer[index-self._bufferstart-2:index-self._bufferstart] == b"/>":
+            return begin + index - start
+        return self._tag_end(index) + self.baseposition
+
+    def build_index(self, chunk_size=65536, processes=1):
+        """index every record of the file in one sequential read
+        
+        The file is fed to a single parser in chunk_size blocks, only the
+        begin and end offsets and the type of the records are kept, no
+        Element tree is built. A record nested inside another one is part
+        of the outer record. The index is also kept as self.index.
+        
+        With processes > 1 (or None for one per core) the file is split in
+        byte ranges that are indexed by a pool of worker processes, see
+        _index_range(). The handle must then come from a named file.
+        
+        returns a RecordIndex of (record_number, begin, end) byte offsets
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes > 1:
+            index = self.index = self._build_index_parallel(processes, chunk_size)
+            return index
+        index = self.index = self._index_to(None, chunk_size)
+        return index
+
+    def _index_to(self, stop=None, chunk_size=65536):
+        """index the records of the file from its start on, up to the first
+        record beginning at or after stop (at self._nextbegin)"""
+        parser = self._make_index_parser(0, stop)
+        self._handle.seek(0)
         try:
-            parser.ParseFile(handle)
+            for data in self._read_chunks(chunk_size):
+                self._feed(parser, data)
+            parser.Parse(b"", True)
         except StopIteration:
-            return rootelem
+            pass
+        return self._index
+
+    def _build_index_parallel(self, processes, chunk_size):
+        """split the file in byte ranges, index them in parallel and merge
         
-        #A return should have happened at this point
-        raise ValueError("Check that file contains target element")
+        Each range is indexed by _index_byte_range in its own process and
+        the record lists are joined in file order. Every range but the
+        first starts on a record start tag found by a plain search, so each
+        range is parsed on up to the next record after it, and that record
+        must be the first one of the next range. Otherwise a range started
+        on a tag inside a comment, a CDATA section or another record and
+        the file is indexed once more serially, at the cost of both builds.
+        The gain depends on the cores available, with a single core the
+        worker processes only add their overhead.
+        """
+        if self._bgzf:
+            raise ValueError("parallel indexing of BGZF files is not supported")
+        filename = getattr(self._handle, "name", None)
+        if not isinstance(filename, str) or not os.path.isfile(filename):
+            raise ValueError("parallel indexing requires a handle opened from a file name")
+        size = os.path.getsize(filename)
+        processes = max(1, min(processes, size // chunk_size))
+        bounds = [size * n // processes for n in range(processes + 1)]
+        settings = {"keyfields": self.keyfields, "targetfield": self.targetfield,
+                    "namestoparse": self.namestoparse, "recordtypes": self.recordtypes,
+                    "namespaces": self.namespaces}
+        declarations = self._namespace_declarations() if self.namespaces else None
+        tasks = [(filename, settings, declarations, bounds[n], bounds[n+1], chunk_size)
+                 for n in range(processes)]
+        
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_index_byte_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        if None in parts:
+            return self.build_index(chunk_size)
+        firstbegins = [part.begins[0] if len(part) else nextbegin
+                       for part, nextbegin in parts]
+        if [nextbegin for part, nextbegin in parts] != firstbegins[1:] + [None]:
+            return self.build_index(chunk_size)
+        index = RecordIndex()
+        for part, nextbegin in parts:
+            index.extend(part)
+        return index
+
+    def _index_range(self, start, stop, chunk_size=65536):
+        """index the records beginning inside [start, stop)
+        
+        A range starting at 0 is parsed from the start of the file. Other
+        ranges resynchronize the parser on the first record start tag at
+        or after start, the records from there on are parsed as children
+        of a synthetic root, and when an element opened before that tag
+        closes parsing resumes after its closing tag. Indexing ends with
+        the first record beginning at or after stop, the last record may
+        end beyond stop.
+        
+        returns (RecordIndex, begin of that next record or None)
+        """
+        if start == 0:
+            return self._index_to(stop, chunk_size), self._nextbegin
+        tags = [recordtype.tag for recordtype in self._record_types()]
+        pattern = _start_tag_pattern(tags, self.namespaces)
+        match = pattern.search(self._mapped_file(), start)
+        position = match.start() if match is not None else None
+        index = RecordIndex()
+        self._nextbegin = None
+        while position is not None:
+            part, complete = self._index_from(position, stop, chunk_size)
+            index.extend(part)
+            position = None if complete else self._resumeposition
+        return index, self._nextbegin
+
+    def _index_from(self, position, stop=None, chunk_size=65536):
+        """index the records from position on, position must lie between
+        records
+        
+        The records are parsed as children of a synthetic root. Indexing
+        ends with the first record beginning at or after stop or at the
+        closing tag of the element enclosing the records. Only when that
+        closing tag ends the document, with nothing but white space after
+        it, are all the records from position on indexed; otherwise more
+        records may follow in another element.
+        
+        returns (RecordIndex, complete), complete is False when indexing
+        stopped at a closing tag before stop or the end of the document,
+        self._resumeposition is then the position after that tag
+        """
+        root = self._synthetic_root() or _RANGE_ROOT
+        if self._bgzf:
+            parser = self._make_index_parser(-len(root), stop)
+        else:
+            parser = self._make_index_parser(position - len(root), stop)
+        index = self._index
+
+        self._handle.seek(position)
+        chunks = self._read_chunks(chunk_size)
+        try:
+            self._feed(parser, root)
+            for data in chunks:
+                self._feed(parser, data)
+        except StopIteration:
+            pass
+        except ExpatError:
+            #the enclosing element closes outside of a record
+            if self._recorddepth or \
+               parser.ErrorCode != errors.codes[errors.XML_ERROR_TAG_MISMATCH]:
+                raise
+            local = parser.ErrorByteIndex - self._bufferstart
+            end = _TAG_END.match(self._buffer, local).end()
+            self._resumeposition = end + self._bufferstart + self.baseposition
+            return index, self._document_ends(end, chunks)
+        return index, True
+
+    def _document_ends(self, end, chunks):
+        """whether only white space follows the buffer position end, chunks
+        yields the rest of the file"""
+        if self._buffer[end:].strip():
+            return False
+        for data in chunks:
+            if data.strip():
+                return False
+        return True
+
+    def _make_index_parser(self, position, stop=None):
+        """make a parser for build_index, records are stored in self._index"""
+        parser = self._new_parser()
+        parser.StartElementHandler = self._index_start_element
+        parser.EndElementHandler = self._index_end_element
+        self.baseposition = position
+        self._stopposition = stop
+        #the first record beginning at or after stop, once it is met
+        self._nextbegin = None
+        self._recordbegin = None
+        self._recorddepth = 0
+        self._recordtype = None
+        self._index = RecordIndex()
+        self._buffer = bytearray()
+        self._bufferstart = 0
+        self._compile_record_types()
         
+        #key extraction state, _keyfields are those of the current record
+        self._keyfields = []
+        for keyfields in self._typekeyfields:
+            for field, steps, attribute in keyfields:
+                self._index.keys.setdefault(field, KeyIndex())
+        if self._index.keys:
+            parser.CharacterDataHandler = self._key_char_data
+            parser.buffer_text = True
+        self._openpath = []
+        self._keycaptures = []
+        return parser
+
+    def _index_start_element(self, name, attrs):
+        if self.namespaces:
+            name = _fixname(name)
+        if self._recorddepth:
+            if name == self._recordtag:
+                self._recorddepth += 1
+            if self._keyfields:
+                if attrs and self.namespaces:
+                    attrs = self._qualify_attributes(attrs)
+                self._key_start_element(name, attrs)
+            return
+        recordtype = self._recordtags.get(name)
+        if recordtype is None:
+            return
+        begin = self._parser.CurrentByteIndex + self.baseposition
+        if self._stopposition is not None and begin >= self._stopposition:
+            self._nextbegin = begin
+            raise StopIteration()
+        self._recordbegin = begin
+        self._recorddepth = 1
+        self._recordtag = name
+        self._recordtype = recordtype
+        self._keyfields = self._typekeyfields[recordtype]
+        #attribute keys of the record element itself
+        if attrs and self.namespaces and self._keyfields:
+            attrs = self._qualify_attributes(attrs)
+        for field, steps, attribute in self._keyfields:
+            if not steps and attribute in attrs:
+                self._add_key(field, attrs[attribute])
+
+    def _index_end_element(self, name):
+        if self._recorddepth:
+            if self.namespaces:
+                name = _fixname(name)
+            if name == self._recordtag:
+                self._recorddepth -= 1
+                if not self._recorddepth:
+                    begin = self._recordbegin
+                    end = self._record_end(begin)
+                    if self._bgzf:
+                        begin, end = self._virtual_offset(begin), self._virtual_offset(end)
+                    self._index.append(begin, end, self._recordtype)
+                    self._keyfields = []
+                    return
+            if self._keyfields:
+                self._key_end_element()
+
+    def _key_start_element(self, name, attrs):
+        """match the open elements of a record against the key paths"""
+        openpath = self._openpath
+        openpath.append((name, attrs))
+        depth = len(openpath)
+        for field, steps, attribute in self._keyfields:
+            if len(steps) != depth or steps[-1][0] != name:
+                continue
+            for (stepname, stepattribute, stepvalue), (openname, openattrs) in \
+                                                    zip(steps, openpath):
+                if stepname != openname or \
+                   not _attribute_matches(openattrs, stepattribute, stepvalue):
+                    break
+            else:
+                if attribute is None:
+                    self._keycaptures.append((field, depth, []))
+                elif attribute in attrs:
+                    self._add_key(field, attrs[attribute])
+
+    def _key_end_element(self):
+        captures = self._keycaptures
+        depth = len(self._openpath)
+        while captures and captures[-1][1] == depth:
+            field, depth, textparts = captures.pop()
+            self._add_key(field, "".join(textparts))
+        self._openpath.pop()
+
+    def _key_char_data(self, data):
+        for capture in self._keycaptures:
+            capture[2].append(data)
+
+    def _add_key(self, field, value):
+        value = value.strip()
+        if value:
+            #the current record is appended to the index when it ends
+            self._index.keys[field].add(value, len(self._index))
+
     def start_element(self, name, attrs):
-        print("{}new name {}".format("-"*(self.currentelem.depth()+1), name))
+        if self.namespaces:
+            name = _fixname(name)
+            if attrs:
+                attrs = self._qualify_attributes(attrs)
+        if self.verbose:
+            print("{}new name {}".format("-"*(self._depth+1), name))
+        self._depth += 1
+        self._textrun = False
         if self.currentelem.indexend is True:
             self._finish_element()
             
-        if name in self.namestoparse:
+        if name in self._parsednames:
             self.savetext = True
             byteindex = self._parser.CurrentByteIndex + self.baseposition
             newelement = Element(name, begin=byteindex)
             newelement.attributes = attrs
             self.currentelem.add_child(newelement)
             self.currentelem = newelement
+            for nameindex in self._nameindexes:
+                try:
+                    nameindex[name].append(newelement)
+                except KeyError:
+                    nameindex[name] = [newelement]
+            recordtype = self._recordtags.get(name)
+            if recordtype is not None:
+                newelement.nameindex = {}
+                self._nameindexes.append(newelement.nameindex)
+                if self._recordtag is None:
+                    #from here on only the names of this record type are parsed
+                    self._recordtag = name
+                    self._parsednames = self._typeparsednames[recordtype]
+                    self._recorddepth = 1
+                elif name == self._recordtag:
+                    #a nested record of the same type is part of the record
+                    self._recorddepth += 1
+            self._textparts = []
+            self._textstack.append(self._textparts)
         else:
             self.savetext = False
         
     def end_element(self, name):
-        if name == self.targetfield:
-            end = self._parser.CurrentByteIndex + len(self.targetfield) + 3 \
-                  + self.baseposition
+        if self.namespaces:
+            name = _fixname(name)
+        self._depth -= 1
+        self._textrun = False
+        if name == self._recordtag:
+            self._recorddepth -= 1
+        if name == self._recordtag and not self._recorddepth:
+            #a parsed last child still waits for its end index
+            if self.currentelem.indexend is True:
+                self._finish_element()
+            end = self._record_end(self.currentelem.indexbegin)
             self.currentelem.indexend = end
+            self.currentelem.text = _join_text(self._textparts)
             self.rootelem.indexend = end
-            raise StopIteration()
-        print("{}end name {}".format("-"*(self.currentelem.depth()+1), name))
+            if self._records is None:
+                raise StopIteration()
+            self._release_record()
+            return
+        if self.verbose:
+            print("{}end name {}".format("-"*(self._depth+1), name))
         if self.currentelem.indexend is True:
             self._finish_element()
         if name == self.currentelem.name:
             self.currentelem.indexend = True        
 
+    def _release_record(self):
+        """hand the finished record to iter_records and reset the tree"""
+        record = self._virtual_tree(self.currentelem)
+        self._records.append((record, record.indexbegin, record.indexend))
+        record.parent = None
+        rootelem = self.rootelem
+        del rootelem.children[:]
+        rootelem.nameindex.clear()
+        self._nameindexes = [rootelem.nameindex]
+        self.currentelem = rootelem
+        self._textparts = []
+        self._textstack = [self._textparts]
+        self._recordtag = None
+        self._recorddepth = 0
+        self._parsednames = frozenset(self._recordtags)
+        self.savetext = False
+
     def char_data(self, data):
-        if data.strip() and self.savetext:
-            self.currentelem.text += data.strip()
+        if self.savetext:
+            if self._textrun:
+                #text split by a chunk boundary continues the last piece
+                self._textparts[-1] += data
+            else:
+                self._textparts.append(data)
+                self._textrun = True
             
     def _finish_element(self):
         """ any element eligible for finishing is saved here
         
-        An element has ended; fix the end byte index and fetch the parent node.
-        This will possibly also stop iteration if the end of the target node is found"""
+        An element has ended; fix the end byte index, join its text and
+        fetch the parent node."""
         assert self.currentelem.indexend is True
         self.currentelem.indexend = self._parser.CurrentByteIndex + self.baseposition
+        if self.currentelem.nameindex is not None:
+            #a nested record no longer collects the elements that follow it
+            self._nameindexes.pop()
+        self.currentelem.text = _join_text(self._textstack.pop())
+        self._textparts = self._textstack[-1]
         self.currentelem = self.currentelem.parent
     
 
-#open file in binary mode for robuster byte offsets.
-xmlFile = open("simple.xml", 'rb')
-
-h = ExpatHandler(xmlFile)
-a = h.parse_from_position()
-print(repr(a))
-for c in a.children:
-    print("child {} exists".format(c.name))
-    print("child {} has {} children and 1 parents".format(c.name, len(c.children)))
-
-print("\n\nnext section\n\n")
-a = h.parse_from_position(c.indexend)
-print(repr(a))
-for c in a.children:
-    print("child {} exists".format(c.name))
-    print("child {} has {} children and 1 parents".format(c.name, len(c.children)))
\ No newline at end of file
+def _stored_signature(meta_data):
+    return tuple(meta_data.get(key) for key in
+                 ("size", "mtime", "head_crc32", "tail_crc32"))
+
+def _join_text(parts):
+    """element text, the stripped text pieces between its child tags"""
+    return "".join([part.strip() for part in parts])
+
+def iter_records(handle, chunk_size=65536, **settings):
+    """yield (record, begin, end) for every record of an XML file
+    
+    settings are ExpatHandler keyword arguments, for example targetfield,
+    namestoparse or recordtypes, see ExpatHandler.iter_records
+    """
+    return ExpatHandler(handle, **settings).iter_records(chunk_size)
+
+def _start_tag_pattern(names, namespaces=False):
+    """regular expression finding the start tags of any of the element names
+    
+    With namespaces the names are {uri}local names, their start tags are
+    found by local name with any prefix.
+    """
+    if namespaces:
+        names = [name.rpartition("}")[2] for name in names]
+        prefix = b"(?:[^\\s/>:]+:)?"
+    else:
+        prefix = b""
+    alternatives = b"|".join(re.escape(name.encode("utf-8")) for name in names)
+    return re.compile(b"<" + prefix + b"(?:" + alternatives + b")[\\s/>]")
+
+def _index_byte_range(task):
+    """pool worker: index the records beginning inside one byte range
+    
+    returns the result of _index_range, or None when the range does not
+    parse, for example after a resynchronization inside a CDATA section
+    """
+    filename, settings, declarations, start, stop, chunk_size = task
+    with open(filename, "rb") as handle:
+        handler = ExpatHandler(handle, **settings)
+        handler._nsdeclarations = declarations
+        try:
+            return handler._index_range(start, stop, chunk_size)
+        except ExpatError:
+            return None
+        finally:
+            handler.close()
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import unittest
+
+    from bgzf import BgzfWriter
+
+    def _temporary_file(data):
+        handle = tempfile.TemporaryFile()
+        handle.write(data)
+        handle.flush()
+        return handle
+
+    def _shape(element):
+        """(name, attributes, text, children) of an Element tree, positions left out"""
+        return (element.name, element.attributes, element.text,
+                [_shape(child) for child in element.children])
+
+    class TestRecordEnds(unittest.TestCase):
+        def _check(self, data, tag="PLANT", namespaces=False):
+            """the record bytes of every way of reading the file agree"""
+            handle = _temporary_file(data)
+            self.addCleanup(handle.close)
+            for chunk_size in (1, 3, 7, 65536):
+                handler = ExpatHandler(handle, targetfield=tag, namestoparse=[tag, "N"],
+                                       namespaces=namespaces)
+                self.addCleanup(handler.close)
+                index = handler.build_index(chunk_size)
+                spans = [(begin, end) for record_number, begin, end in index]
+                streamed = list(handler.iter_records(chunk_size))
+                self.assertEqual([(begin, end) for record, begin, end in streamed], spans)
+                records = [handler.get_record(i) for i in range(len(index))]
+                self.assertEqual([(record.indexbegin, record.indexend) for record in records],
+                                 spans)
+                self.assertEqual([_shape(record) for record, begin, end in streamed],
+                                 [_shape(record) for record in records])
+            return [data[begin:end] for begin, end in spans]
+
+        def test_closing_tag_with_white_space(self):
+            self.assertEqual(self._check(b"<C><PLANT><N>a</N></PLANT ></C>"),
+                             [b"<PLANT><N>a</N></PLANT >"])
+            self.assertEqual(self._check(b"<C><PLANT><N>a</N></PLANT\n>\n</C>"),
+                             [b"<PLANT><N>a</N></PLANT\n>"])
+
+        def test_empty_records(self):
+            self.assertEqual(self._check(b'<C><PLANT a="x>y"/><PLANT/>'
+                                         b'<PLANT><N/></PLANT></C>'),
+                             [b'<PLANT a="x>y"/>', b"<PLANT/>", b"<PLANT><N/></PLANT>"])
+
+        def test_nested_records(self):
+            data = (b"<C><PLANT><N>a</N><PLANT><N>b</N></PLANT><N>c</N></PLANT>"
+                    b"<PLANT><N>d</N></PLANT></C>")
+            self.assertEqual(self._check(data),
+                             [b"<PLANT><N>a</N><PLANT><N>b</N></PLANT><N>c</N></PLANT>",
+                              b"<PLANT><N>d</N></PLANT>"])
+            handle = _temporary_file(data)
+            self.addCleanup(handle.close)
+            handler = ExpatHandler(handle, namestoparse=["PLANT", "N"])
+            self.addCleanup(handler.close)
+            self.assertEqual([n.text for n in handler.get_record(0).findall("N")], ["a", "c"])
+            self.assertEqual([n.text for n in handler.get_record(0).findall("PLANT/N")], ["b"])
+
+        def test_prefixed_closing_tag(self):
+            self.assertEqual(self._check(b'<C xmlns:p="u"><p:PLANT><N>a</N></p:PLANT  >'
+                                         b'<p:PLANT/></C>', "{u}PLANT", True),
+                             [b"<p:PLANT><N>a</N></p:PLANT  >", b"<p:PLANT/>"])
+
+    def _plants(first, last):
+        return b"".join(b"<PLANT><N>%d</N></PLANT>\n" % n for n in range(first, last))
+
+    def _section(first, last):
+        return b"<SECTION>\n" + _plants(first, last) + b"</SECTION>\n"
+
+    class TestKeyIndex(unittest.TestCase):
+        def setUp(self):
+            self.keyindex = KeyIndex()
+            for key, record in (("delta", 3), ("alpha", 0), ("beta", 1), ("alpha", 2),
+                                ("alphabet", 4), ("gamma", 5), ("beta", 1)):
+                self.keyindex.add(key, record)
+
+        def test_exact(self):
+            self.assertEqual(self.keyindex.exact("alpha"), [0, 2])
+            self.assertEqual(self.keyindex.exact("beta"), [1])
+            self.assertEqual(self.keyindex.exact("alp"), [])
+            self.assertTrue("gamma" in self.keyindex)
+            self.assertFalse("epsilon" in self.keyindex)
+
+        def test_prefix(self):
+            self.assertEqual(self.keyindex.prefix("alpha"), [0, 2, 4])
+            self.assertEqual(self.keyindex.prefix("g"), [5])
+            self.assertEqual(self.keyindex.prefix("z"), [])
+            self.assertEqual(len(self.keyindex.prefix("")), 6)
+
+        def test_range(self):
+            self.assertEqual(self.keyindex.range("alphabet", "delta"), [4, 1])
+            self.assertEqual(self.keyindex.range("b", "gamma"), [1, 3])
+            self.assertEqual(self.keyindex.range("delta", "delta"), [])
+
+        def test_record_keys(self):
+            data = (b'<CATALOG>\n<PLANT id="p1"><N type="common">Bloodroot</N>'
+                    b'<N type="botanical">Sanguinaria</N><ZONE value="4"/></PLANT>\n'
+                    b'<PLANT id="p2"><N type="common">Columbine</N>'
+                    b'<N type="common">Western Columbine</N><ZONE value="3"/></PLANT>\n'
+                    b'<PLANT id="p3"><N type="common">Marsh Marigold</N>'
+                    b'<ZONE value="4"/></PLANT>\n</CATALOG>\n')
+            handle = _temporary_file(data)
+            self.addCleanup(handle.close)
+            handler = ExpatHandler(handle, namestoparse=["PLANT", "N"],
+                                   keyfields={"common": "N[@type=common]", "zone": "ZONE/@value",
+                                              "id": "@id"})
+            self.addCleanup(handler.close)
+            self.assertEqual(handler.key_index("common").exact("Western Columbine"), [1])
+            self.assertEqual(handler.key_index("common").exact("Sanguinaria"), [])
+            self.assertEqual(handler.key_index("common").prefix("Columbine"), [1])
+            self.assertEqual(handler.key_index("zone").exact("4"), [0, 2])
+            self.assertEqual(handler.key_index("zone").range("3", "4"), [1])
+            self.assertEqual(handler.key_index("id").range("p2", "p9"), [1, 2])
+            self.assertEqual([record.attributes["id"] for record in
+                              handler.lookup("zone", "4")], ["p1", "p3"])
+
+    class TestRecordTypes(unittest.TestCase):
+        PLANTS = "http://example.com/plants"
+        SHRUBS = "http://example.com/shrubs"
+        DATA = (b'<?xml version="1.0"?>\n'
+                b'<CATALOG xmlns="http://example.com/plants" '
+                b'xmlns:s="http://example.com/shrubs">\n'
+                b'<PLANT><N>Bloodroot</N></PLANT>\n'
+                b'<s:SHRUB code="A1"><s:N>Azalea</s:N></s:SHRUB>\n'
+                b'<PLANT><N>Columbine</N><s:N>not a plant name</s:N></PLANT>\n'
+                b'<s:SHRUB code="B2"><s:N>Boxwood</s:N><N>not a shrub name</N></s:SHRUB>\n'
+                b'</CATALOG>\n')
+
+        def setUp(self):
+            handle = _temporary_file(self.DATA)
+            self.addCleanup(handle.close)
+            plant, shrub = "{%s}" % self.PLANTS, "{%s}" % self.SHRUBS
+            self.handler = ExpatHandler(handle, namespaces=True, recordtypes=[
+                RecordType(plant + "PLANT", [plant + "N"], {"name": plant + "N"}),
+                RecordType(shrub + "SHRUB", [shrub + "N"],
+                           {"name": shrub + "N", "code": "@code"})])
+            self.addCleanup(self.handler.close)
+
+        def test_index(self):
+            index = self.handler.build_index()
+            self.assertEqual(list(index.types), [0, 1, 0, 1])
+            self.assertEqual([self.DATA[begin:end].split(b">")[0] for n, begin, end in index],
+                             [b"<PLANT", b'<s:SHRUB code="A1"', b"<PLANT", b'<s:SHRUB code="B2"'])
+            self.assertEqual(self.handler.record_numbers("{%s}SHRUB" % self.SHRUBS), [1, 3])
+
+        def test_keys(self):
+            names = self.handler.key_index("name")
+            self.assertEqual([names.exact(name) for name in
+                              ("Bloodroot", "Azalea", "Columbine", "Boxwood")], [[0], [1], [2], [3]])
+            self.assertEqual(len(names), 4)
+            self.assertEqual(self.handler.key_index("code").exact("B2"), [3])
+
+        def test_records_parsed_on_their_own(self):
+            shrub = self.handler.get_record(3)
+            self.assertEqual(shrub.name, "{%s}SHRUB" % self.SHRUBS)
+            self.assertEqual(shrub.attributes, {"code": "B2"})
+            self.assertEqual([n.text for n in shrub.findall("{%s}N" % self.SHRUBS)],
+                             ["Boxwood"])
+            plant = self.handler.get_record(2)
+            self.assertEqual([n.text for n in plant.findall("{%s}N" % self.PLANTS)],
+                             ["Columbine"])
+            self.assertEqual(plant.findall("{%s}N" % self.SHRUBS), [])
+
+        def test_nested_record_types(self):
+            handle = _temporary_file(b"<C><A><X>1</X><B><X>2</X></B><X>3</X></A></C>")
+            self.addCleanup(handle.close)
+            handler = ExpatHandler(handle, recordtypes=[RecordType("A", ["X", "B"]),
+                                                        RecordType("B", ["X"])])
+            self.addCleanup(handler.close)
+            record = handler.get_record(0)
+            self.assertEqual([x.text for x in record.get_all_children_by_name("X")],
+                             ["1", "2", "3"])
+            self.assertEqual([x.text for x in record.find("B").get_all_children_by_name("X")],
+                             ["2"])
+            self.assertEqual([x.text for x in record.findall("X")], ["1", "3"])
+
+        def test_streamed_records(self):
+            self.assertEqual([(record.name.rpartition("}")[2], begin, end) for record, begin, end
+                              in self.handler.iter_records(chunk_size=16)],
+                             [(name, begin, end) for name, (n, begin, end) in
+                              zip(["PLANT", "SHRUB"] * 2, self.handler.build_index())])
+
+    class TestBgzfRecords(unittest.TestCase):
+        def setUp(self):
+            #about 5 BGZF blocks of records
+            self.data = (b"<CATALOG>\n" + b"".join(b'<PLANT><NAMES><N type="common">plant %d</N>'
+                                                   b'</NAMES><ZONE value="%d"/></PLANT>\n'
+                                                   % (n, n % 9) for n in range(5000))
+                         + b"</CATALOG>\n")
+            self.plain = _temporary_file(self.data)
+            self.addCleanup(self.plain.close)
+            compressed = tempfile.TemporaryFile()
+            writer = BgzfWriter(compressed)
+            writer.write(self.data)
+            writer.flush()
+            compressed.seek(0)
+            self.compressed = BgzfReader(compressed)
+            self.addCleanup(self.compressed.close)
+
+        def test_reader(self):
+            reader = self.compressed
+            self.assertEqual(reader.read(), self.data)
+            reader.seek(0)
+            blocks = list(reader.chunks())
+            self.assertTrue(len(blocks) > 4)
+            self.assertEqual(b"".join(data for virtual_offset, data in blocks), self.data)
+            position = sum(len(data) for virtual_offset, data in blocks[:3])
+            reader.seek(blocks[3][0] + 100)
+            self.assertEqual(reader.read(50), self.data[position + 100:position + 150])
+            self.assertEqual(reader.tell(), blocks[3][0] + 150)
+
+        def test_records_match_the_plain_file(self):
+            settings = {"keyfields": {"zone": "ZONE/@value"}}
+            plain = ExpatHandler(self.plain, **settings)
+            self.addCleanup(plain.close)
+            compressed = ExpatHandler(self.compressed, **settings)
+            plainindex = plain.build_index()
+            index = compressed.build_index()
+            self.assertEqual(len(index), 5000)
+            self.assertEqual(plainindex.keys["zone"].exact("4"), index.keys["zone"].exact("4"))
+            for i in (0, 1, 1234, 2500, 4999):
+                record = compressed.get_record(i)
+                self.assertEqual(_shape(record), _shape(plain.get_record(i)))
+                self.assertEqual((record.indexbegin, record.indexend), (index.begins[i], index.ends[i]))
+                self.assertEqual(compressed._record_bytes(index.begins[i], index.ends[i]),
+                                 plain._record_bytes(plainindex.begins[i], plainindex.ends[i]))
+            self.assertEqual([(begin, end) for record, begin, end in compressed.iter_records()],
+                             [(begin, end) for n, begin, end in index])
+
+    class TestSidecarIndex(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+            self.filename = os.path.join(self.directory, "catalog.xml")
+            self.index_filename = os.path.join(self.directory, "catalog.idx")
+            self._write(b"<CATALOG>\n" + _plants(0, 50) + b"</CATALOG>\n")
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def _write(self, data):
+            with open(self.filename, "wb") as handle:
+                handle.write(data)
+
+        def _handler(self, handle, **settings):
+            handler = ExpatHandler(handle, index_filename=self.index_filename,
+                                   keyfields={"name": "N"}, **settings)
+            self.addCleanup(handler.close)
+            return handler
+
+        def test_round_trip(self):
+            with open(self.filename, "rb") as handle:
+                built = self._handler(handle).build_index()
+                self._handler(handle).save_index()
+                handler = self._handler(handle)
+                loaded = handler.load_index()
+                self.assertIsNotNone(loaded)
+                self.assertEqual(list(loaded), list(built))
+                self.assertEqual(list(loaded.types), list(built.types))
+                self.assertEqual(loaded.keys["name"].keys, sorted(built.keys["name"].keys))
+                self.assertEqual(handler.lookup("name", "42")[0].find("N").text, "42")
+
+        def test_stale_sidecar_is_ignored(self):
+            with open(self.filename, "rb") as handle:
+                self._handler(handle).save_index()
+            #same size, other content
+            self._write(b"<CATALOG>\n" + _plants(0, 50).replace(b"<N>1", b"<N>9")
+                        + b"</CATALOG>\n")
+            with open(self.filename, "rb") as handle:
+                handler = self._handler(handle)
+                self.assertIsNone(handler.load_index())
+                self.assertEqual(handler.lookup("name", "1"), [])
+                self.assertEqual(len(handler.key_index("name").prefix("9")), 12)
+
+        def test_other_settings_are_ignored(self):
+            with open(self.filename, "rb") as handle:
+                self._handler(handle).save_index()
+                self.assertIsNone(ExpatHandler(handle, index_filename=self.index_filename,
+                                               keyfields={"zone": "ZONE/@value"}).load_index())
+                self.assertIsNone(ExpatHandler(handle, index_filename=self.index_filename,
+                                               keyfields={"name": "N"},
+                                               targetfield="N").load_index())
+
+    class TestUpdateIndex(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+            self.filename = os.path.join(self.directory, "catalog.xml")
+            self.index_filename = os.path.join(self.directory, "catalog.idx")
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def _update(self, data):
+            """write the file, update its sidecar and return the record names
+            
+            The names are taken from the name key index, which is only
+            right when the index matches the file.
+            """
+            with open(self.filename, "wb") as handle:
+                handle.write(data)
+            with open(self.filename, "rb") as handle:
+                handler = ExpatHandler(handle, index_filename=self.index_filename,
+                                       keyfields={"name": "N"})
+                names = handler.update_index().keys["name"]
+                names.sort()
+                recordnames = dict(zip(names.records, names.keys))
+                names = [recordnames.get(i) for i in range(len(handler))]
+                for i, name in enumerate(names):
+                    self.assertEqual(handler.get_record(i).find("N").text, name)
+                handler.close()
+            return names
+
+        def test_records_appended_to_the_root(self):
+            self._update(b"<CATALOG>\n" + _plants(0, 5) + b"</CATALOG>\n")
+            self.assertEqual(self._update(b"<CATALOG>\n" + _plants(0, 9) + b"</CATALOG>\n\n"),
+                             [str(n) for n in range(9)])
+
+        def test_small_file_rewritten_and_grown(self):
+            self._update(b"<CATALOG>\n" + _plants(100, 103) + b"</CATALOG>\n")
+            self.assertEqual(self._update(b"<CATALOG>\n" + _plants(100, 104).replace(b"100", b"900")
+                                          + b"</CATALOG>\n"), ["900", "101", "102", "103"])
+
+        def test_records_appended_in_a_new_element(self):
+            self._update(b"<CATALOG>" + _section(0, 5) + b"</CATALOG>")
+            self.assertEqual(self._update(b"<CATALOG>" + _section(0, 5) + _section(5, 10)
+                                          + b"</CATALOG>"),
+                             [str(n) for n in range(10)])
+
+    class TestParallelIndex(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+            self.filename = os.path.join(self.directory, "catalog.xml")
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def _compare(self, data, processes=4):
+            with open(self.filename, "wb") as handle:
+                handle.write(data)
+            with open(self.filename, "rb") as handle:
+                handler = ExpatHandler(handle, keyfields={"name": "N"})
+                serial = handler.build_index(4096)
+                parallel = handler.build_index(4096, processes=processes)
+                handler.close()
+            self.assertEqual(list(parallel), list(serial))
+            self.assertEqual(parallel.keys["name"].keys, serial.keys["name"].keys)
+            return len(serial)
+
+        def test_records_of_one_element(self):
+            self.assertEqual(self._compare(b"<CATALOG>\n" + _plants(0, 2000)
+                                           + b"</CATALOG>\n"), 2000)
+
+        def test_records_in_several_elements(self):
+            self.assertEqual(self._compare(b"<CATALOG>\n" + b"".join(
+                                 _section(200*n, 200*(n+1)) for n in range(40))
+                                           + b"</CATALOG>\n"), 8000)
+
+        def test_record_tag_in_comment(self):
+            #the split lands inside the comment, on the record tag it holds
+            comment = b"<!--" + b" "*100000 + b"<PLANT>fake</PLANT>-->\n"
+            self.assertEqual(self._compare(b"<CATALOG>\n" + _plants(0, 10000) + comment
+                                           + _plants(10000, 20000) + b"</CATALOG>\n",
+                                           processes=2), 20000)
+
+        def test_record_tag_in_cdata(self):
+            cdata = b"<N><![CDATA[" + b" "*100000 + b"<PLANT>fake</PLANT>]]></N>\n"
+            self.assertEqual(self._compare(b"<CATALOG>\n" + _plants(0, 10000) + cdata
+                                           + _plants(10000, 20000) + b"</CATALOG>\n",
+                                           processes=2), 20000)
+
+    unittest.main(exit=False)
+
+    #open file in binary mode for robuster byte offsets.
+    xmlFile = open("simple.xml", 'rb')
+
+    h = ExpatHandler(xmlFile, verbose=True)
+    a = h.parse_from_position()
+    print(repr(a))
+    for c in a.children:
+        print("child {} exists".format(c.name))
+        print("child {} has {} children and 1 parents".format(c.name, len(c.children)))
+
+    print("\n\nnext section\n\n")
+    a = h.parse_from_position(c.indexend)
+    print(repr(a))
+    for c in a.children:
+        print("child {} exists".format(c.name))
+        print("child {} has {} children and 1 parents".format(c.name, len(c.children)))
+
+    print("\n\nwhole file index\n\n")
+    for record_number, begin, end in h.build_index():
+        print("record {} spans bytes [{}, {})".format(record_number, begin, end))
+
+    print("\n\nrandom access\n\n")
+    record = h.get_record(1)
+    print(repr(record))
+    for c in record.children:
+        print("child {} has text {!r}".format(c.name, c.text))
+    print("common names {}".format(
+                [n.text for n in record.findall("NAMES/N[@type=common]")]))
+    h.close()
+
+    print("\n\nkey lookups\n\n")
+    h = ExpatHandler(xmlFile, keyfields={"common": "NAMES/N[@type=common]",
+                                         "zone": "ZONE/@value"})
+    for record in h.lookup("common", "Western Columbine"):
+        print("Western Columbine is {!r}".format(record))
+    print("zones from 3 to 5: records {}".format(h.key_index("zone").range("3", "5")))
+    h.close()
+
+    print("\n\nstreaming\n\n")
+    for record, begin, end in iter_records(xmlFile, chunk_size=64):
+        print("{!r} streamed, names {}".format(record,
+                                     [n.text for n in record.findall("NAMES/N")]))
@@ -0,0 +1,171 @@
+"""Region queries over XML records with sequence coordinates
+
+RegionIndex puts the coordinates of every record indexed by an
+ExpatHandler in a FeatureBinCollection, so the records overlapping a
+region are found from the bins and only those records are read and
+parsed. The coordinates are two key fields of the handler:
+
+    handler = ExpatHandler(handle, keyfields={"begin": "LOCATION/@begin",
+                                              "end": "LOCATION/@end"})
+    regions = RegionIndex(handler)
+    for record in regions.overlapping(1000, 2000):
+        ...
+
+Binning_routine lives in the directory above this one, callers must put
+that directory on the module search path, for example
+
+    PYTHONPATH=.. python region_index.py
+"""
+from bisect import bisect_left
+
+from Binning_routine import FeatureBinCollection
+
+
+class RegionIndex(object):
+    """Find the records of an ExpatHandler by sequence region
+
+    Each record is stored in the bins as a (begin, end, fileoffset, length)
+    tuple, the fileidx layout of the FeatureBinCollection docstring:
+    [begin, end) are the coordinates taken from the beginfield and
+    endfield key fields of the handler and [fileoffset, fileoffset+length)
+    is the range of the record in the file (virtual offsets for a BGZF
+    file). A record with several coordinate values spans from the
+    smallest begin to the largest end, records lacking one are left out.
+    Coordinates must be integers indexed at zero, see FeatureBinCollection,
+    a record whose begin lies after its end raises a ValueError.
+
+    The queries return generators, a record is parsed by the handler only
+    when the generator reaches it. Records come in file order.
+    """
+    def __init__(self, handler, beginfield="begin", endfield="end", length=None):
+        self.handler = handler
+        self._beginfield = beginfield
+        self._endfield = endfield
+        self._bins = FeatureBinCollection(length)
+        self._bins.extend(self._features())
+
+    def _features(self):
+        handler = self.handler
+        begins = _coordinates(handler.key_index(self._beginfield), min)
+        ends = _coordinates(handler.key_index(self._endfield), max)
+        for record_number, fileoffset, fileend in handler.index:
+            if record_number in begins and record_number in ends:
+                begin, end = begins[record_number], ends[record_number]
+                if begin > end:
+                    raise ValueError("record {} begins at {}, after its end {}"
+                                     .format(record_number, begin, end))
+                yield begin, end, fileoffset, fileend - fileoffset
+
+    def __len__(self):
+        return len(self._bins)
+
+    def overlapping(self, start, stop):
+        """the records overlapping [start, stop)"""
+        return self._records(self._bins[start:stop])
+
+    def within(self, start, stop):
+        """the records lying entirely inside [start, stop)"""
+        return self._records(self._bins.within(start, stop))
+
+    def containing(self, position):
+        """the records covering position"""
+        return self._records(self._bins.containing(position))
+
+    def _records(self, features):
+        begins = self.handler.index.begins
+        for fileoffset in sorted(set(feature[2] for feature in features)):
+            yield self.handler.get_record(bisect_left(begins, fileoffset))
+
+
+def _coordinates(keyindex, choose):
+    """{record number: coordinate} from the keys of a KeyIndex"""
+    coordinates = {}
+    for key, record_number in zip(keyindex.keys, keyindex.records):
+        try:
+            value = int(key)
+        except ValueError:
+            raise ValueError("record {} has the coordinate {!r}, not an integer"
+                             .format(record_number, key))
+        if record_number in coordinates:
+            value = choose(coordinates[record_number], value)
+        coordinates[record_number] = value
+    return coordinates
+
+
+if __name__ == "__main__":
+    import random
+    import tempfile
+    import unittest
+    from expat_indexing_test import ExpatHandler
+
+    def _catalog(records):
+        """a file of PLANT records with the (begin, end) LOCATION of records"""
+        data = ['<?xml version="1.0" encoding="utf-8" ?>\n<CATALOG>']
+        for n, (begin, end) in enumerate(records):
+            data.append('\n  <PLANT>\n    <NAMES><N type="common">plant {}</N></NAMES>'
+                        '\n    <LOCATION begin="{}" end="{}" />\n  </PLANT>'.format(n, begin, end))
+        data.append("\n</CATALOG>\n")
+        handle = tempfile.TemporaryFile()
+        handle.write("".join(data).encode("utf-8"))
+        handle.flush()
+        return handle
+
+    def _handler(handle):
+        return ExpatHandler(handle, namestoparse=["PLANT", "NAMES", "N", "LOCATION"],
+                            keyfields={"begin": "LOCATION/@begin", "end": "LOCATION/@end"})
+
+    class TestRegionIndex(unittest.TestCase):
+        def setUp(self):
+            rand = random.Random(5)
+            self.records = []
+            for n in range(400):
+                begin = rand.randint(0, 10**6)
+                span = rand.choice([0, 1, 50, rand.randint(0, 5000), rand.randint(0, 10**5)])
+                self.records.append((begin, begin + span))
+            handle = _catalog(self.records)
+            self.addCleanup(handle.close)
+            self.handler = _handler(handle)
+            self.addCleanup(self.handler.close)
+            self.regions = RegionIndex(self.handler)
+
+        def _names(self, records):
+            return [int(record.find("NAMES/N").text.split()[1]) for record in records]
+
+        def test_queries_match_brute_force(self):
+            rand = random.Random(9)
+            records = self.records
+            self.assertEqual(len(self.regions), len(records))
+            for i in range(100):
+                start = rand.randint(0, 10**6)
+                stop = start + rand.choice([0, 1, 300, 20000, 300000])
+                self.assertEqual(self._names(self.regions.overlapping(start, stop)),
+                    [n for n, (begin, end) in enumerate(records)
+                     if begin < stop and start < end or begin == end and start <= begin < stop
+                     or begin <= start and stop <= end])
+                self.assertEqual(self._names(self.regions.within(start, stop)),
+                    [n for n, (begin, end) in enumerate(records)
+                     if start <= begin and end <= stop])
+                self.assertEqual(self._names(self.regions.containing(start)),
+                    [n for n, (begin, end) in enumerate(records)
+                     if begin <= start < end or begin == start])
+
+        def test_begin_after_end(self):
+            handle = _catalog([(10, 20), (300, 200)])
+            self.addCleanup(handle.close)
+            handler = _handler(handle)
+            self.addCleanup(handler.close)
+            with self.assertRaises(ValueError) as context:
+                RegionIndex(handler)
+            self.assertTrue("record 1 " in str(context.exception))
+
+    unittest.main(exit=False)
+
+    handle = _catalog([(120, 480), (300, 900), (5000, 5200), (0, 20000)])
+    handler = _handler(handle)
+    regions = RegionIndex(handler)
+    for name, query in (("overlapping [400, 1000)", regions.overlapping(400, 1000)),
+                        ("within [100, 1000)", regions.within(100, 1000)),
+                        ("containing 5100", regions.containing(5100))):
+        print("{}: {}".format(name, [record.find("NAMES/N").text for record in query]))
+    handler.close()
+    handle.close()